@@ -0,0 +1,127 @@
+"""Benchmark the client receive path on a synthetic chunked stream.
+
+Reports the CPU time per GiB and the peak RSS of the chunked decoding and
+writing done by `RemoteMarsClientSession._transfer`, compared with the
+previous path based on urllib3's ``read_chunked``::
+
+    python benchmarks/transfer.py --size 4 --chunk 65536
+"""
+
+import argparse
+import io
+import os
+import resource
+import time
+
+from cads_mars_server.chunked import ChunkedReader, PositionalWriter
+
+GiB = 1024**3
+
+
+class SyntheticStream(io.RawIOBase):
+    """A socket replaying the same framed chunk, then ``ENDR``."""
+
+    def __init__(self, size, chunk):
+        data = bytes(i % 251 for i in range(chunk))
+        frame = b"%x\r\n%s\r\n" % (chunk, data)
+        count = max(1, (1024 * 1024) // len(frame))
+        self.block = memoryview(frame * count)
+        self.trailer = b"4\r\nENDR\r\n0\r\n\r\n"
+        self.frames = size // chunk
+        self.count = count
+        self.pending = memoryview(
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+        )
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.pending:
+            if self.frames >= self.count:
+                self.pending = self.block
+                self.frames -= self.count
+            elif self.frames:
+                self.pending = self.block[: len(self.block) // self.count * self.frames]
+                self.frames = 0
+            elif self.trailer:
+                self.pending = memoryview(self.trailer)
+                self.trailer = b""
+            else:
+                return 0
+
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+def legacy(stream, fd):
+    """Receive as before, relying on the chunk decoding of urllib3."""
+    import http.client
+
+    import urllib3
+
+    class Socket:
+        def makefile(self, mode):
+            return stream
+
+    response = http.client.HTTPResponse(Socket(), method="POST")
+    response.begin()
+    raw = urllib3.HTTPResponse(
+        body=response,
+        headers=dict(response.getheaders()),
+        status=response.status,
+        preload_content=False,
+        original_response=response,
+    )
+
+    with os.fdopen(os.dup(fd), "wb") as f:
+        for chunk in raw.read_chunked():
+            if len(chunk) == 4:
+                continue
+            f.write(chunk)
+
+
+def current(stream, fd):
+    stream.readline()  # Status line
+    stream.readline()  # Headers
+    stream.readline()
+    writer = PositionalWriter(fd)
+    for marker, data in ChunkedReader(stream.readinto):
+        if marker is None:
+            writer.write(data)
+    writer.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=float, default=2, help="GiB to transfer")
+    parser.add_argument("--chunk", type=int, default=64 * 1024, help="Chunk size")
+    parser.add_argument("--target", default=os.devnull)
+    parser.add_argument("--method", choices=("current", "legacy"), default="current")
+    args = parser.parse_args()
+
+    size = int(args.size * GiB)
+    stream = io.BufferedReader(SyntheticStream(size, args.chunk), 1024 * 1024)
+    fd = os.open(args.target, os.O_WRONLY | os.O_CREAT, 0o644)
+
+    start = time.process_time()
+    elapsed = time.perf_counter()
+    try:
+        globals()[args.method](stream, fd)
+    finally:
+        os.close(fd)
+    elapsed = time.perf_counter() - elapsed
+    cpu = time.process_time() - start
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{args.method}: chunk={args.chunk} size={size / GiB:.1f} GiB"
+        f" cpu={cpu / (size / GiB):.3f} s/GiB wall={size / GiB / elapsed:.2f} GiB/s"
+        f" peak_rss={rss:.1f} MiB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,578 @@
+"""An asynchronous client, for workers running many retrievals in one process.
+
+`AsyncRemoteMarsClientCluster` has the same retries, failover and `Result` as
+`RemoteMarsClientCluster`, as a coroutine. It speaks HTTP directly over asyncio
+streams: the server closes the connection after each response, so there are
+no connections to keep in a pool, and `requests` would block the event loop.
+The chunked stream is decoded incrementally with `ChunkScanner`, and the
+writes to the target are done in the default executor, with small buffers, so
+that hundreds of retrievals fit in a process.
+
+Cancelling the task of a retrieval closes its connection, which makes the
+server kill its MARS process.
+"""
+
+import asyncio
+import email.parser
+import http
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+from . import tools
+from .chunked import (
+    ENDR,
+    EROR,
+    INDX,
+    MARKERS,
+    PAYLOAD_MARKERS,
+    PROG,
+    RWND,
+    ChunkScanner,
+    PositionalWriter,
+    ProtocolError,
+)
+from .client import (
+    ClientError,
+    RequestList,
+    Result,
+    error_result,
+    keepalive_socket_options,
+    mars_headers,
+    open_target,
+    write_index,
+)
+from .health import backoff, default_health
+
+LOG = logging.getLogger(__name__)
+
+
+async def health_call(health, method, *args):
+    """Call `method` of `health`, in the executor if it locks a shared file."""
+    if health.path is None:
+        return method(*args)
+    return await asyncio.get_event_loop().run_in_executor(None, method, *args)
+
+
+class ResponseTimeout(asyncio.TimeoutError):
+    """The server took the request, but did not answer in time."""
+
+
+class Response:
+    def __init__(self, status, reason, headers, reader, writer):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+
+    async def text(self, timeout=None):
+        if "Content-Length" in self.headers:
+            length = int(self.headers["Content-Length"])
+            data = await asyncio.wait_for(self.reader.readexactly(length), timeout)
+        else:
+            data = await asyncio.wait_for(self.reader.read(), timeout)
+        return data.decode(errors="replace")
+
+    def close(self):
+        self.writer.close()
+
+
+async def request(method, url, body=None, headers=None, timeout=None, wait=None):
+    """Send a request and return the `Response` once its headers are received.
+
+    `timeout` applies to the connection, `wait` to the headers of the response.
+    The response must be closed.
+    """
+    parts = urllib.parse.urlsplit(url)
+    secure = parts.scheme == "https"
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(
+            parts.hostname, parts.port or (443 if secure else 80), ssl=secure or None
+        ),
+        timeout,
+    )
+    try:
+        sock = writer.get_extra_info("socket")
+        for option in keepalive_socket_options():
+            sock.setsockopt(*option)
+
+        lines = [
+            f"{method} {parts.path or '/'} HTTP/1.1",
+            f"Host: {parts.netloc}",
+            "Connection: close",
+        ]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b""))
+        await writer.drain()
+
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), wait)
+        except asyncio.TimeoutError:
+            raise ResponseTimeout() from None
+    except BaseException:
+        writer.close()
+        raise
+
+    status, _, rest = head.partition(b"\r\n")
+    _, code, *reason = status.decode("latin-1").split(" ", 2)
+    return Response(
+        int(code),
+        reason[0] if reason else "",
+        email.parser.BytesHeaderParser().parsebytes(rest),
+        reader,
+        writer,
+    )
+
+
+class StreamDecoder:
+    """Decode the chunked stream of a retrieval fed in blocks, into `writer`.
+
+    `feed` returns the markers met, other than ``RWND`` which is applied to
+    `writer` in order, as ``(marker, payload)`` tuples.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.scanner = ChunkScanner(self._on_chunk)
+        self.chunk = bytearray()
+        self.marker = None
+        self.events = []
+
+    def _on_chunk(self, data, size):
+        if size != 4 and self.marker is None:
+            self.writer.write(data)
+            return
+
+        self.chunk += data
+        if len(self.chunk) < size:
+            return
+        chunk = bytes(self.chunk)
+        self.chunk.clear()
+
+        if self.marker is not None:
+            self.events.append((self.marker, chunk))
+            self.marker = None
+        elif chunk == RWND:
+            self.writer.rewind()
+        elif chunk in PAYLOAD_MARKERS:
+            self.marker = chunk
+        elif chunk in MARKERS:
+            self.events.append((chunk, None))
+        else:
+            raise ValueError(f"Unknown message {chunk}")
+
+    def feed(self, data):
+        self.scanner.feed(data)
+        events, self.events = self.events, []
+        return events
+
+    @property
+    def done(self):
+        return self.scanner.done
+
+
+class AsyncRemoteMarsClientSession:
+    read_size = 256 * 1024
+    write_buffer_size = 256 * 1024
+
+    def __init__(
+        self,
+        *,
+        url,
+        request,
+        environ,
+        target,
+        open_mode="wb",
+        position=0,
+        timeout=60,
+        log=LOG,
+        health=None,
+        progress=None,
+        progress_interval=10,
+        stall_timeout=None,
+        index=False,
+    ):
+        self.url = url
+        self.request = request
+        self.environ = environ
+        self.target = target
+        self.uid = None
+        self.timeout = timeout
+        self.log = log
+        self.health = health or default_health()
+        self.open_mode = open_mode
+        self.position = position
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stall_timeout = stall_timeout
+        self.index = index
+        self.writer = None
+        self._pending = None
+
+    @property
+    def received(self):
+        """Number of bytes of the result received so far."""
+        return 0 if self.writer is None else self.writer.written
+
+    async def _run(self, func, *args):
+        """Run `func` in the executor, where it finishes even if the task is cancelled."""
+        loop = asyncio.get_event_loop()
+        self._pending = loop.run_in_executor(None, func, *args)
+        return await asyncio.shield(self._pending)
+
+    async def _close(self, fd):
+        pending, self._pending = self._pending, None
+        if pending is not None and not pending.done():
+            try:
+                # The executor may still be writing to `fd`, which could be reused
+                await asyncio.wait({pending})
+            except asyncio.CancelledError:
+                pending.add_done_callback(lambda _: os.close(fd))
+                raise
+        if pending is not None and not pending.cancelled():
+            # Reported by the await, if any
+            pending.exception()
+        os.close(fd)
+
+    async def _transfer(self, response):
+        start = time.time()
+
+        fd = open_target(self.target, self.open_mode)
+        try:
+            writer = PositionalWriter(fd, self.position, self.write_buffer_size)
+            self.writer = writer
+            decoder = StreamDecoder(writer)
+            endr_received = False
+            index = []
+
+            while True:
+                data = await asyncio.wait_for(
+                    response.reader.read(self.read_size), self.stall_timeout
+                )
+                if not data:
+                    break
+
+                for marker, payload in await self._run(decoder.feed, data):
+                    if marker == EROR:
+                        try:
+                            message = json.loads(payload)
+                        except json.decoder.JSONDecodeError:
+                            raise ValueError("Error received")
+                        LOG.error(f"Error received {message}")
+                        raise ClientError(message)
+
+                    if marker == ENDR:
+                        endr_received = True
+
+                    if marker == PROG and self.progress is not None:
+                        self.progress(json.loads(payload))
+
+                    if marker == INDX:
+                        index.append(payload)
+
+            if not decoder.done:
+                raise ProtocolError("Response ended prematurely")
+
+            await self._run(writer.flush)
+
+            if not endr_received:
+                raise ValueError("ENDR not received")
+
+            if self.index:
+                await self._run(
+                    write_index,
+                    self.target,
+                    index,
+                    self.position,
+                    self.open_mode,
+                    self.log,
+                )
+
+            total = writer.written
+        finally:
+            response.close()
+            await self._close(fd)
+
+        elapsed = time.time() - start
+        self.log.info(
+            f"Transfered {tools.bytes(total)} in {elapsed:.1f}s,"
+            f" {tools.bytes(total / elapsed)}"
+        )
+
+    async def _call(self, method, url):
+        response = await request(method, url, timeout=self.timeout, wait=self.timeout)
+        try:
+            if response.status >= 400:
+                raise IOError(f"{response.status} {response.reason} for {url}")
+            return await response.text(self.timeout)
+        finally:
+            response.close()
+
+    async def execute(self):
+        self.log.info(f"Calling {self.url} {self.request} {self.environ}")
+
+        error = None
+
+        headers = {"Content-Type": "application/json"}
+        headers.update(
+            mars_headers(
+                self.progress, self.progress_interval, self.stall_timeout, self.index
+            )
+        )
+
+        body = json.dumps(dict(request=self.request, environ=self.environ)).encode()
+
+        posted = False
+        try:
+            # No need to ping a host known to be healthy
+            if not await health_call(self.health, self.health.is_healthy, self.url):
+                head = await request(
+                    "HEAD", self.url, timeout=self.timeout, wait=self.timeout
+                )
+                head.close()
+                if head.status == http.HTTPStatus.SERVICE_UNAVAILABLE:
+                    # The server is draining, e.g. before a restart
+                    self.log.warning(f"Host {self.url} is unavailable")
+                    await health_call(self.health, self.health.failure, self.url)
+                    return Result(
+                        error=IOError(f"{head.status} {head.reason}"),
+                        retry_next_host=True,
+                    )
+
+            posted = True
+            r = await request(
+                "POST",
+                self.url,
+                body=body,
+                headers=headers,
+                timeout=self.timeout,
+                wait=self.stall_timeout,
+            )
+        except asyncio.TimeoutError as e:
+            self.log.error(f"Timeout {e!r}")
+            # A host slow to answer a retrieval it took is busy, not down
+            if not (posted and isinstance(e, ResponseTimeout)):
+                await health_call(self.health, self.health.failure, self.url)
+            return Result(error=e, retry_next_host=True)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            self.log.error(f"Connection error {e!r}")
+            await health_call(self.health, self.health.failure, self.url)
+            return Result(error=e, retry_next_host=True)
+
+        code = r.status
+        if code in (
+            http.HTTPStatus.BAD_GATEWAY,
+            http.HTTPStatus.GATEWAY_TIMEOUT,
+            http.HTTPStatus.SERVICE_UNAVAILABLE,
+        ):
+            await health_call(self.health, self.health.failure, self.url)
+        else:
+            await health_call(self.health, self.health.success, self.url)
+
+        if code >= 400:
+            error = IOError(f"{code} {r.reason} for {self.url}")
+            self.log.error(f"HTTP error {error}")
+
+        if code not in (http.HTTPStatus.BAD_REQUEST, http.HTTPStatus.OK):
+            try:
+                message = await r.text(self.timeout)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                message = str(e)
+            finally:
+                r.close()
+            return error_result(code, r.headers, message or str(error), error, self.log)
+
+        uid = r.headers["X-MARS-UID"]
+        self.uid = uid
+
+        if code == http.HTTPStatus.BAD_REQUEST:
+            r.close()
+            if "X-MARS-EXIT-CODE" in r.headers:
+                exitcode = int(r.headers["X-MARS-EXIT-CODE"])
+                self.log.error(f"MARS client exited with code {exitcode}")
+
+        if code == http.HTTPStatus.OK:
+            try:
+                await self._transfer(r)
+            except ClientError as e:
+                self.log.exception("Error transferring file (ClientError)")
+                return Result(
+                    error=e,
+                    retry_same_host=e.retry_same_host,
+                    retry_next_host=e.retry_next_host,
+                )
+            except asyncio.TimeoutError as e:
+                self.log.error(f"Transfer stalled for more than {self.stall_timeout}s")
+                return Result(error=e, retry_same_host=True, retry_next_host=True)
+            except (ProtocolError, OSError, asyncio.IncompleteReadError) as e:
+                self.log.exception("Error transferring file (ProtocolError)")
+                await health_call(self.health, self.health.failure, self.url)
+                return Result(error=e, retry_same_host=True, retry_next_host=True)
+            except Exception as e:
+                self.log.exception("Error transferring file (Other errors)")
+                error = e
+
+        logfile = None
+
+        try:
+            logfile = await self._call("GET", self.url + "/" + uid)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            self.log.exception("Error getting log file")
+
+        try:
+            await self._call("DELETE", self.url + "/" + uid)
+            self.uid = None
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            self.log.exception("Error deleting log file")
+
+        return Result(error=error, message=logfile or str(error))
+
+
+class AsyncRemoteMarsClient:
+    def __init__(
+        self,
+        *,
+        url,
+        open_mode="wb",
+        position=0,
+        retries=3,
+        delay=10,
+        timeout=60,
+        log=LOG,
+        health=None,
+        progress=None,
+        progress_interval=10,
+        stall_timeout=None,
+        index=False,
+    ):
+        self.url = url
+        self.retries = retries
+        self.delay = delay
+        self.timeout = timeout
+        self.log = log
+        self.open_mode = open_mode
+        self.position = position
+        self.health = health
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stall_timeout = stall_timeout
+        self.index = index
+
+    async def execute(self, request, environ, target):
+        session = AsyncRemoteMarsClientSession(
+            url=self.url,
+            request=request,
+            environ=environ,
+            target=target,
+            timeout=self.timeout,
+            open_mode=self.open_mode,
+            position=self.position,
+            log=self.log,
+            health=self.health,
+            progress=self.progress,
+            progress_interval=self.progress_interval,
+            stall_timeout=self.stall_timeout,
+            index=self.index,
+        )
+
+        for i in range(self.retries):
+            reply = await session.execute()
+            if not reply.error:
+                return reply
+
+            if not reply.retry_same_host:
+                return reply
+
+            self.log.error(f"Error {reply}")
+            self.log.error(f"Retry on the same host {self.url}")
+
+            await asyncio.sleep(backoff(self.delay, i))
+
+        return reply
+
+
+class AsyncRemoteMarsClientCluster:
+    def __init__(
+        self,
+        urls,
+        retries=3,
+        delay=10,
+        timeout=60,
+        log=LOG,
+        health=None,
+        progress=None,
+        progress_interval=10,
+        stall_timeout=None,
+        index=False,
+    ):
+        self.urls = urls
+        self.retries = retries
+        self.delay = delay
+        self.timeout = timeout
+        self.log = log
+        self.health = health or default_health()
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stall_timeout = stall_timeout
+        self.index = index
+
+    async def execute(self, request, environ, target):
+        if isinstance(request, dict):
+            return await self._execute(request, environ, target, "wb", 0)
+
+        requests = RequestList(request, target)
+        for req, open_mode, position in requests:
+            result = await self._execute(req, environ, target, open_mode, position)
+            if not requests.add(result):
+                break
+        return result
+
+    async def _execute(self, request, environ, target, open_mode, position):
+        reply = None
+        urls = await health_call(self.health, self.health.order, self.urls)
+        async for url in self.usable(urls):
+            client = self.client(url, open_mode, position)
+
+            reply = await client.execute(request, environ, target)
+            if not reply.error:
+                return reply
+
+            if not reply.retry_next_host:
+                return reply
+
+            self.log.error(f"Error {reply}")
+            self.log.error(f"Retry on the next host {url}")
+
+        return reply
+
+    async def usable(self, urls):
+        """Yield `urls` as `RemoteMarsClientCluster.usable` does."""
+        deferred = []
+        for url in urls:
+            if await health_call(self.health, self.health.acquire, url):
+                yield url
+            else:
+                deferred.append(url)
+        for url in deferred:
+            yield url
+
+    def client(self, url, open_mode, position):
+        return AsyncRemoteMarsClient(
+            url=url,
+            retries=self.retries,
+            delay=self.delay,
+            timeout=self.timeout,
+            open_mode=open_mode,
+            position=position,
+            log=self.log,
+            health=self.health,
+            progress=self.progress,
+            progress_interval=self.progress_interval,
+            stall_timeout=self.stall_timeout,
+            index=self.index,
+        )
@@ -0,0 +1,253 @@
+"""A cache of results on the client side, shared by the workers of a host.
+
+Results are kept in a directory, under the hash of their request, made
+canonical so that the order and case of its keys do not matter. Workers
+asking for the same request hold a lock on its entry while it is retrieved,
+so that the others wait for it instead of retrieving it again. The locks are
+a fixed set of 4096 files, each shared by the requests whose hash starts
+alike, which are never removed, so that all the workers always lock the same
+file for a request without the locks growing with the cache. Entries are
+evicted least recently used first, when the cache grows over ``max_size``
+bytes, or after ``max_age`` seconds. The total size is kept up to date as
+entries are added, so that the cache is only scanned when it is over
+``max_size``, or now and then to find the expired entries.
+
+Results are delivered as reflinks when the file system can, or else as
+copies. With ``link``, they are delivered as hard links when possible, which
+keeps the space of an evicted entry in use until the target is removed.
+Entries are made read-only, and the clients write results to new files rather
+than in place, so that a target linked to an entry never changes it.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from .client import Result
+from .gribindex import sidecar
+
+LOG = logging.getLogger(__name__)
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+def canonical(request):
+    """Return `request` with its keys and values in a canonical form."""
+    if isinstance(request, (list, tuple)):
+        return [canonical(r) for r in request]
+
+    result = {}
+    for key, value in request.items():
+        values = value if isinstance(value, (list, tuple)) else str(value).split("/")
+        result[key.strip().lower()] = [str(v).strip().lower() for v in values]
+    return result
+
+
+def request_key(request):
+    text = json.dumps(canonical(request), sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def clone(source, target):
+    """Copy `source` to `target`, sharing their blocks if the file system can."""
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+class ResultCache:
+    def __init__(self, path, max_size=None, max_age=None, link=False):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.link = link
+        os.makedirs(path, exist_ok=True)
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.data")
+
+    def lock(self, entry):
+        key = os.path.basename(entry)[: -len(".data")]
+        return os.path.join(self.path, "locks", f"{key[:3]}.lock")
+
+    @contextlib.contextmanager
+    def _locked(self, path, blocking=True):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(fd, flags)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+    def _deliver(self, entry, target):
+        for source, path in ((entry, target), (sidecar(entry), sidecar(target))):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            if not os.path.exists(source):
+                continue
+            if self.link:
+                try:
+                    os.link(source, path)
+                    continue
+                except OSError:
+                    # E.g. not on the same file system
+                    pass
+            clone(source, path)
+
+    def _store(self, scratch, entry, message):
+        with open(f"{entry}.log", "w") as f:
+            f.write(message or "")
+        if os.path.exists(sidecar(scratch)):
+            os.chmod(sidecar(scratch), 0o444)
+            os.replace(sidecar(scratch), sidecar(entry))
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(sidecar(entry))
+        os.chmod(scratch, 0o444)
+        os.replace(scratch, entry)
+
+    def execute(self, request, target, retrieve, index=False):
+        """Deliver the result of `request` to `target`, calling `retrieve` if needed.
+
+        `retrieve` is called with the path to retrieve into, and returns a
+        `Result`. Results in error are not kept. With `index`, entries without
+        an index of their GRIB messages are retrieved again.
+        """
+        key = request_key(request)
+        entry = self.entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        os.makedirs(os.path.dirname(self.lock(entry)), exist_ok=True)
+
+        with self._locked(self.lock(entry)):
+            if os.path.exists(entry) and (not index or os.path.exists(sidecar(entry))):
+                LOG.info(f"Result of {request} found in cache {entry}")
+                # Entries of other users cannot be touched, which only matters
+                # to the order of eviction
+                with contextlib.suppress(PermissionError):
+                    os.utime(entry)
+                self._deliver(entry, target)
+                try:
+                    with open(f"{entry}.log") as f:
+                        message = f.read()
+                except FileNotFoundError:
+                    message = None
+                return Result(message=message)
+
+            scratch = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                result = retrieve(scratch)
+                if result.error:
+                    # Leave the partial result where it would have been
+                    if os.path.exists(scratch):
+                        os.replace(scratch, target)
+                    return result
+
+                size = os.path.getsize(scratch)
+                self._store(scratch, entry, result.message)
+                self._deliver(entry, target)
+            finally:
+                for path in (scratch, sidecar(scratch)):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(path)
+
+        self._added(size)
+        return result
+
+    def _state(self, update):
+        """Update the size of the cache and the time of its last scan, under lock."""
+        path = os.path.join(self.path, "state")
+        with self._locked(os.path.join(self.path, "lock")):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (FileNotFoundError, ValueError):
+                state = None
+            state = update(state)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(f"{path}.tmp", path)
+            return state
+
+    def _added(self, size):
+        if self.max_size is None and self.max_age is None:
+            return
+
+        def update(state):
+            if state is None:
+                # Unknown, e.g. a new cache, until the first scan
+                state = dict(size=0, scanned=0)
+            state["size"] += size
+            return state
+
+        state = self._state(update)
+        if (
+            not state["scanned"]
+            or (self.max_size is not None and state["size"] > self.max_size)
+            or (
+                self.max_age is not None
+                and time.time() - state["scanned"] > min(self.max_age / 10, 3600)
+            )
+        ):
+            self.evict()
+
+    def _entries(self):
+        for shard in os.scandir(self.path):
+            if not shard.is_dir() or shard.name == "locks":
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".data"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, entry.path
+
+    def _remove(self, entry):
+        with self._locked(self.lock(entry), blocking=False) as locked:
+            # Skip entries being retrieved or delivered
+            if not locked:
+                return False
+            for path in (entry, sidecar(entry), f"{entry}.log"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+            return True
+
+    def evict(self, now=None):
+        """Remove entries according to `max_size` and `max_age`, return how many."""
+        if self.max_size is None and self.max_age is None:
+            return 0
+
+        now = time.time() if now is None else now
+        removed = 0
+
+        def scan(state):
+            nonlocal removed
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, entry in entries:
+                expired = self.max_age is not None and now - mtime > self.max_age
+                too_big = self.max_size is not None and total > self.max_size
+                if not (expired or too_big):
+                    break
+                if self._remove(entry):
+                    LOG.info(f"Evicted {entry} from the cache")
+                    removed += 1
+                    total -= size
+            return dict(size=total, scanned=now)
+
+        self._state(scan)
+        return removed
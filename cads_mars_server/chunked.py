@@ -0,0 +1,355 @@
+"""Parsing and writing of the chunked stream relayed from MARS.
+
+MARS writes its output to the server using the HTTP chunked framing. Four
+bytes chunks are control markers, some of which are followed by a chunk
+holding their payload (e.g. a JSON error message after ``EROR``).
+"""
+
+import os
+
+RWND = b"RWND"
+EROR = b"EROR"
+ENDR = b"ENDR"
+# Sent by the server, only to clients asking for them
+PROG = b"PROG"
+INDX = b"INDX"
+
+MARKERS = (RWND, EROR, ENDR, PROG, INDX)
+
+# Markers whose payload is sent in the following chunk
+PAYLOAD_MARKERS = (EROR, PROG, INDX)
+
+MAX_HEADER_SIZE = 1024
+
+
+class ProtocolError(IOError):
+    pass
+
+
+class ChunkedReader:
+    """Decode a chunked stream into a reusable, preallocated buffer.
+
+    Iterating yields ``(marker, data)`` tuples. For payload chunks ``marker`` is
+    ``None`` and ``data`` is a memoryview into the internal buffer, which is only
+    valid until the next iteration. Large chunks are yielded in several pieces.
+    For control chunks ``marker`` is one of `MARKERS` and ``data`` is the payload
+    of the marker, as bytes, or ``None``.
+    """
+
+    def __init__(self, readinto, bufsize=1024 * 1024):
+        self.readinto = readinto
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def _compact(self):
+        n = self.end - self.start
+        if n:
+            # Only partial headers or control chunks are left behind, so this is small
+            self.buffer[:n] = self.buffer[self.start : self.end]
+        self.start = 0
+        self.end = n
+
+    def _fill(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            self._compact()
+
+        n = self.readinto(self.view[self.end :])
+        if not n:
+            raise ProtocolError("Response ended prematurely")
+        self.end += n
+
+    def _need(self, n):
+        if n > len(self.buffer):
+            raise ProtocolError(f"Chunk of {n} bytes does not fit in the buffer")
+
+        if len(self.buffer) - self.start < n:
+            self._compact()
+
+        while self.end - self.start < n:
+            self._fill()
+
+    def _readline(self):
+        while True:
+            eol = self.buffer.find(b"\r\n", self.start, self.end)
+            if eol >= 0:
+                start = self.start
+                self.start = eol + 2
+                return start, eol
+
+            if self.end - self.start > MAX_HEADER_SIZE:
+                raise ProtocolError("Invalid chunk header")
+
+            self._fill()
+
+    def _read_size(self):
+        start, end = self._readline()
+        semicolon = self.buffer.find(b";", start, end)
+        if semicolon >= 0:
+            end = semicolon
+        try:
+            return int(self.buffer[start:end], 16)
+        except ValueError:
+            raise ProtocolError("Invalid chunk length") from None
+
+    def _end_of_chunk(self):
+        self._need(2)
+        if self.buffer[self.start] != 0x0D or self.buffer[self.start + 1] != 0x0A:
+            raise ProtocolError("Missing chunk terminator")
+        self.start += 2
+
+    def _read_small_chunk(self, size):
+        self._need(size)
+        data = self.view[self.start : self.start + size]
+        self.start += size
+        self._end_of_chunk()
+        return data
+
+    def _skip_trailers(self):
+        try:
+            while True:
+                start, end = self._readline()
+                if start == end:
+                    return
+        except ProtocolError:
+            # Trailers are optional
+            pass
+
+    def __iter__(self):
+        buffer = self.buffer
+        view = self.view
+
+        while True:
+            # Fast path: the whole data chunk is already buffered
+            eol = buffer.find(b"\r\n", self.start, self.end)
+            if eol >= 0:
+                try:
+                    size = int(buffer[self.start : eol], 16)
+                except ValueError:
+                    size = 0
+                begin = eol + 2
+                end = begin + size
+                if (
+                    size > 4
+                    and end + 2 <= self.end
+                    and buffer[end] == 0x0D
+                    and buffer[end + 1] == 0x0A
+                ):
+                    self.start = end + 2
+                    yield None, view[begin:end]
+                    continue
+
+            size = self._read_size()
+
+            if size == 0:
+                self._skip_trailers()
+                return
+
+            if size == 4:
+                chunk = self._read_small_chunk(4)
+                for marker in MARKERS:
+                    if chunk == marker:
+                        break
+                else:
+                    raise ValueError(f"Unknown message {chunk.tobytes()}")
+
+                payload = None
+                if marker in PAYLOAD_MARKERS:
+                    payload = self._read_small_chunk(self._read_size()).tobytes()
+
+                yield marker, payload
+                continue
+
+            remaining = size
+            while remaining:
+                if self.start == self.end:
+                    self._fill()
+                n = min(remaining, self.end - self.start)
+                yield None, view[self.start : self.start + n]
+                self.start += n
+                remaining -= n
+
+            self._end_of_chunk()
+
+
+class Reframer:
+    """A `readinto` over chunks already decoded, framed again for `ChunkedReader`.
+
+    This is slower than reading the raw stream, but keeps the chunk boundaries
+    the markers depend on, with HTTP clients that only give decoded chunks.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b"")
+        self.done = False
+
+    def readinto(self, buffer):
+        while not self.pending:
+            if self.done:
+                return 0
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.done = True
+                self.pending = memoryview(b"0\r\n\r\n")
+                break
+            if chunk:
+                self.pending = memoryview(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+def frame(marker, payload=None):
+    """Return the chunks of a control marker, and of its payload if any."""
+    data = b"4\r\n%s\r\n" % (marker,)
+    if payload is not None:
+        data += b"%x\r\n%s\r\n" % (len(payload), payload)
+    return data
+
+
+class ChunkScanner:
+    """Follow the chunked framing of a stream relayed as it is.
+
+    This tells the server when it is between two chunks, so that it can
+    insert its own, and optionally passes the payload of each chunk to
+    ``on_chunk(data, size)``, ``size`` being the size of the whole chunk.
+    With `relay`, the end of the stream is held back so that chunks can
+    also be appended.
+    """
+
+    def __init__(self, on_chunk=None):
+        self.on_chunk = on_chunk
+        self.header = b""
+        self.payload = 0
+        self.size = 0
+        self.crlf = 0
+        self.done = False
+        # Where the last chunk started in the data fed, negative if before it
+        self.last = 0
+
+    @property
+    def at_boundary(self):
+        return not (self.done or self.header or self.payload or self.crlf)
+
+    def feed(self, data):
+        pos = 0
+        end = len(data)
+        while pos < end and not self.done:
+            if self.payload:
+                n = min(self.payload, end - pos)
+                if self.on_chunk is not None:
+                    self.on_chunk(memoryview(data)[pos : pos + n], self.size)
+                self.payload -= n
+                pos += n
+                continue
+
+            if self.crlf:
+                n = min(self.crlf, end - pos)
+                self.crlf -= n
+                pos += n
+                continue
+
+            eol = data.find(b"\n", pos)
+            if eol < 0:
+                self.header += data[pos:]
+                if len(self.header) > MAX_HEADER_SIZE:
+                    raise ProtocolError("Invalid chunk header")
+                return
+
+            line = self.header + data[pos:eol]
+            start = pos - len(self.header)
+            self.header = b""
+            pos = eol + 1
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise ProtocolError(f"Invalid chunk length {line[:32]!r}") from None
+
+            if size == 0:
+                # Trailers may follow, nothing can be inserted anymore
+                self.done = True
+                self.last = start
+            else:
+                self.size = self.payload = size
+                self.crlf = 2
+
+    def relay(self, data):
+        """Feed `data` and return what can be relayed of it.
+
+        The chunk header being read is only returned once complete, and the
+        last chunk and trailers never are, so that the caller can end the
+        stream itself.
+        """
+        if self.done:
+            return b""
+
+        held = self.header
+        self.feed(data)
+
+        if self.done:
+            if self.last < 0:
+                return b""
+            return held + data[: self.last]
+
+        n = len(held) + len(data) - len(self.header)
+        if not held:
+            return memoryview(data)[:n]
+        return (held + data)[:n]
+
+
+class PositionalWriter:
+    """Batch small writes into a preallocated buffer, flushed with `os.pwrite`.
+
+    Data is written from ``position`` onwards, so that `rewind` can discard
+    everything written since, whatever the mode the file was opened with.
+    """
+
+    def __init__(self, fd, position=0, bufsize=4 * 1024 * 1024, direct=64 * 1024):
+        self.fd = fd
+        self.direct = min(direct, bufsize)
+        self.position = position
+        self.offset = position
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+        self.used = 0
+
+    def _pwrite(self, data):
+        while data:
+            n = os.pwrite(self.fd, data, self.offset)
+            self.offset += n
+            data = data[n:]
+
+    def write(self, data):
+        n = len(data)
+        if self.used + n > len(self.buffer):
+            self.flush()
+
+        if n >= self.direct:
+            # Large pieces are written as they are, saving a copy
+            self.flush()
+            self._pwrite(data)
+            return
+
+        self.view[self.used : self.used + n] = data
+        self.used += n
+
+    def flush(self):
+        if self.used:
+            self._pwrite(self.view[: self.used])
+            self.used = 0
+
+    def rewind(self):
+        self.used = 0
+        self.offset = self.position
+        os.ftruncate(self.fd, self.position)
+
+    @property
+    def written(self):
+        return self.offset + self.used - self.position
@@ -5,8 +5,6 @@ import sys
 
 import click
 
-from . import client, server
-
 
 # Create empty click group
 @click.group()
@@ -17,6 +15,23 @@ def mars_cli() -> None:
 logger = logging.getLogger(__name__)
 
 
+def setup_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(process)d %(levelname)s %(module)s - %(funcName)s: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+
+def read_server_list(server_list):
+    if os.path.exists(server_list):
+        with open(server_list) as f:
+            return [url for url in f.read().splitlines() if url.strip()]
+    return [
+        "http://localhost:9000",
+    ]
+
+
 @mars_cli.command("client")
 @click.argument(
     "request_file",
@@ -41,26 +56,66 @@ logger = logging.getLogger(__name__)
     help=("File which contains the list of URLs of the servers."),
     default="./server.list",
 )
-def this_client(request_file, target, uid, server_list) -> None:
+@click.option(
+    "--index",
+    help="Write the index of the GRIB messages of the result next to the target",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--stripes",
+    help="Split the request and retrieve it from up to this many servers at once",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--cache-dir",
+    help="Directory of a cache of results, shared with the other clients of the host",
+    default=None,
+)
+@click.option(
+    "--cache-size",
+    help="Size in bytes over which the cache evicts the least recently used results",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--cache-link",
+    help="Deliver the results of the cache as hard links rather than copies",
+    is_flag=True,
+    default=False,
+)
+def this_client(
+    request_file,
+    target,
+    uid,
+    server_list,
+    index,
+    stripes,
+    cache_dir,
+    cache_size,
+    cache_link,
+) -> None:
     """Spawn a MARS client to execute a request. Pass the request as a JSON file."""
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s %(process)d %(levelname)s %(module)s - %(funcName)s: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
+    from . import client
+
+    setup_logging()
+
+    urls = read_server_list(server_list)
+    cache = None
+    if cache_dir is not None:
+        from .cache import ResultCache
+
+        cache = ResultCache(cache_dir, max_size=cache_size, link=cache_link)
 
-    if os.path.exists(server_list):
-        with open(server_list) as f:
-            urls = f.read().splitlines()
-    else:
-        urls = [
-            "http://localhost:9000",
-        ]
     cluster = client.RemoteMarsClientCluster(
         urls=urls,
         retries=3,
         delay=10,
         # timeout=None,
+        index=index,
+        stripes=stripes,
+        cache=cache,
     )
 
     with open(request_file) as f:
@@ -101,8 +156,112 @@ def this_client(request_file, target, uid, server_list) -> None:
 @click.option(
     "--logdir",
     "-l",
-    help="Path to the log directory",
-    default=".",
+    help="Path to the log directory (default: the current directory)",
+    default=None,
+)
+@click.option(
+    "--log-max-age",
+    help=(
+        "Age in seconds after which logs are removed"
+        " (default: logs are kept, as with 0)"
+    ),
+    type=int,
+    default=None,
+)
+@click.option(
+    "--log-max-size",
+    help="Total size in bytes of the logs above which the oldest are removed",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--log-cache-slots",
+    help="Number of logs of finished requests kept in memory (0 to disable)",
+    type=int,
+    default=0,
+)
+@click.option(
+    "--quotas",
+    help="JSON file with the per-user concurrency and bandwidth quotas (reloaded on change)",
+    default=None,
+)
+@click.option(
+    "--trace",
+    help="JSON lines file to which a trace of each request is appended",
+    default=None,
+)
+@click.option(
+    "--trace-max-bytes",
+    help="Size at which the trace file is rotated",
+    type=int,
+    default=100 * 1024 * 1024,
+)
+@click.option(
+    "--trace-backups",
+    help="Number of rotated trace files to keep",
+    type=int,
+    default=5,
+)
+@click.option(
+    "--reuse-port",
+    help=(
+        "Allow several servers on the same port, to restart without downtime:"
+        " start the new server, then send SIGTERM to the old one"
+    ),
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--drain-timeout",
+    help=(
+        "On SIGTERM, seconds to wait for the running requests before"
+        " terminating them (SIGUSR1 only stops taking new requests)"
+    ),
+    type=int,
+    default=None,
+)
+@click.option(
+    "--placement",
+    help=(
+        "Pin each retrieval and its MARS process to a set of CPUs: those of a"
+        " NUMA node (numa) or groups of --placement-size CPUs (cores), in turn"
+    ),
+    type=click.Choice(["none", "numa", "cores"]),
+    default="none",
+)
+@click.option(
+    "--placement-size",
+    help="Number of CPUs per retrieval with --placement cores",
+    type=int,
+    default=2,
+)
+@click.option(
+    "--priority-key",
+    help="Field of the environ of requests giving their class, for --priority",
+    default="class",
+)
+@click.option(
+    "--priority",
+    help=(
+        "Niceness and I/O priority of the MARS processes of a class of requests,"
+        " e.g. archive=10,idle or default=,be/4 (can be repeated)"
+    ),
+    multiple=True,
+)
+@click.option(
+    "--profile-threshold",
+    help=(
+        "Profile the relay of requests, and keep the profile of those taking"
+        " more than this many seconds, served at /profile/<uid>"
+    ),
+    type=float,
+    default=None,
+)
+@click.option(
+    "--profile-sample",
+    help="Fraction of the requests profiled, with --profile-threshold",
+    type=float,
+    default=1.0,
 )
 @click.option(
     "--pidfile",
@@ -116,12 +275,60 @@ def this_client(request_file, target, uid, server_list) -> None:
     default=False,
 )
 def this_server(
-    mars_executable, host, port, timeout, logdir, pidfile, daemonize
+    mars_executable,
+    host,
+    port,
+    timeout,
+    logdir,
+    log_max_age,
+    log_max_size,
+    log_cache_slots,
+    quotas,
+    trace,
+    trace_max_bytes,
+    trace_backups,
+    reuse_port,
+    drain_timeout,
+    placement,
+    placement_size,
+    priority_key,
+    priority,
+    profile_threshold,
+    profile_sample,
+    pidfile,
+    daemonize,
 ) -> None:
     """Set up a MARS server to execute requests."""
+    from . import server
+
+    setup_logging()
+
+    logdir = logdir or "."
+
     logger.info(f"Starting Server {host}:{port} {logdir}")
 
-    _server = server.setup_server(mars_executable, host, port, timeout, logdir)
+    _server = server.setup_server(
+        mars_executable,
+        host,
+        port,
+        timeout,
+        logdir,
+        quotas=quotas,
+        trace=trace,
+        trace_max_bytes=trace_max_bytes,
+        trace_backups=trace_backups,
+        log_max_age=log_max_age or None,
+        log_max_size=log_max_size,
+        log_cache_slots=log_cache_slots,
+        reuse_port=reuse_port,
+        drain_timeout=drain_timeout,
+        placement=placement,
+        placement_size=placement_size,
+        priority_key=priority_key,
+        priorities=priority,
+        profile_threshold=profile_threshold,
+        profile_sample=profile_sample,
+    )
 
     if daemonize:
         # TODO:use that with modern python
@@ -148,3 +355,55 @@ def this_server(
             f.write(str(os.getpid()))
 
     _server.serve_forever()
+
+
+@mars_cli.command("replay")
+@click.argument("trace_file", nargs=1)
+@click.option(
+    "--server-list",
+    "-s",
+    help=("File which contains the list of URLs of the servers."),
+    default="./server.list",
+)
+@click.option(
+    "--speed",
+    help="Time scaling of the trace: 2 replays twice as fast, 0 as fast as possible",
+    type=float,
+    default=1.0,
+)
+@click.option(
+    "--max-workers",
+    help="Maximum number of concurrent requests",
+    type=int,
+    default=64,
+)
+@click.option(
+    "--target-dir",
+    help="Directory in which the results are temporarily written",
+    default=None,
+)
+@click.option(
+    "--output",
+    "-o",
+    help="JSON lines file to which the outcome of each request is written",
+    default="-",
+)
+def this_replay(
+    trace_file, server_list, speed, max_workers, target_dir, output
+) -> None:
+    """Replay a trace written by the server against a list of servers."""
+    from . import replay, trace
+
+    setup_logging()
+
+    urls = read_server_list(server_list)
+    with click.open_file(output, "w") as f:
+        for outcome in replay.replay(
+            trace.read(trace_file),
+            urls,
+            speed=speed,
+            max_workers=max_workers,
+            target_dir=target_dir,
+        ):
+            f.write(json.dumps(outcome) + "\n")
+            f.flush()
@@ -1,33 +1,93 @@
+import contextlib
 import http
 import json
 import logging
 import os
-import random
 import socket
+import threading
 import time
 
-import requests
-import setproctitle
-import urllib3
-from urllib3.connectionpool import HTTPConnectionPool
-
-from .tools import bytes
+from .chunked import (
+    ENDR,
+    EROR,
+    INDX,
+    PROG,
+    RWND,
+    ChunkedReader,
+    PositionalWriter,
+    Reframer,
+)
+from .chunked import ProtocolError as ChunkedProtocolError
+from .gribindex import sidecar, write_sidecar
+from .health import backoff, default_health
+from .tools import bytes, unshare
 
 LOG = logging.getLogger(__name__)
 
+# The HTTP transport is created on first use, so that importing this module
+# (e.g. in short-lived CADS workers) does not pull in `requests` and `urllib3`.
+_SESSION = None
+
+# Lets a session find the sockets opened on its behalf, so that it can be cancelled
+_LOCAL = threading.local()
+
+
+def keepalive_socket_options():
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60 * 10))
+    options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10))
+    options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3))
+    return options
+
+
+def session():
+    """Return the process-wide HTTP session, creating it on first use."""
+    global _SESSION
+
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
-class ConnectionWithKeepAlive(HTTPConnectionPool.ConnectionCls):  # type: ignore[valid-type,misc]
-    def _new_conn(self):
-        conn = super()._new_conn()
-        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        if hasattr(socket, "TCP_KEEPIDLE"):
-            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60 * 10)
-        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
-        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
-        return conn
+        def track(connection):
+            on_socket = getattr(_LOCAL, "on_socket", None)
+            if on_socket is not None:
+                on_socket(connection.sock)
+
+        class TrackedHTTPConnection(HTTPConnection):
+            def connect(self):
+                super().connect()
+                track(self)
+
+        class TrackedHTTPSConnection(HTTPSConnection):
+            def connect(self):
+                super().connect()
+                track(self)
+
+        class TrackedHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = TrackedHTTPConnection
+
+        class TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = TrackedHTTPSConnection
+
+        class KeepAliveAdapter(HTTPAdapter):
+            def init_poolmanager(self, *args, **kwargs):
+                kwargs["socket_options"] = (
+                    HTTPConnection.default_socket_options + keepalive_socket_options()
+                )
+                super().init_poolmanager(*args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = {
+                    "http": TrackedHTTPConnectionPool,
+                    "https": TrackedHTTPSConnectionPool,
+                }
 
+        _SESSION = requests.Session()
+        _SESSION.mount("http://", KeepAliveAdapter())
+        _SESSION.mount("https://", KeepAliveAdapter())
 
-HTTPConnectionPool.ConnectionCls = ConnectionWithKeepAlive
+    return _SESSION
 
 
 class Result:
@@ -65,7 +125,120 @@ class ClientError(Exception):
         return f"MARS client error {self.message}"
 
 
+def error_result(code, headers, message, error, log=LOG):
+    """Return the `Result` of a POST answered with the status `code`."""
+    retry_same_host = code in (
+        http.HTTPStatus.BAD_GATEWAY,
+        http.HTTPStatus.GATEWAY_TIMEOUT,
+        http.HTTPStatus.INTERNAL_SERVER_ERROR,
+        http.HTTPStatus.REQUEST_TIMEOUT,
+        http.HTTPStatus.SERVICE_UNAVAILABLE,
+    )
+
+    retry_next_host = code in (http.HTTPStatus.TOO_MANY_REQUESTS,)
+
+    if "X-MARS-SIGNAL" in headers:
+        signal = int(headers["X-MARS-SIGNAL"])
+        log.error(f"MARS client kill by signal {signal}")
+
+    if "X-MARS-RETRY-SAME-HOST" in headers:
+        retry_same_host = int(headers["X-MARS-RETRY-SAME-HOST"])
+
+    if "X-MARS-RETRY-NEXT-HOST" in headers:
+        retry_next_host = int(headers["X-MARS-RETRY-NEXT-HOST"])
+
+    return Result(
+        error=error,
+        message=message,
+        retry_same_host=retry_same_host,
+        retry_next_host=retry_next_host or retry_same_host,
+    )
+
+
+def mars_headers(progress, progress_interval, stall_timeout, index):
+    """Return the headers asking the server for progress reports and an index."""
+    headers = {}
+    if progress is not None or stall_timeout is not None:
+        # Progress reports also keep the connection busy while MARS is silent,
+        # so they must come more often than the stall timeout
+        interval = progress_interval
+        if stall_timeout is not None:
+            interval = min(interval, stall_timeout / 2)
+        headers["X-MARS-PROGRESS"] = str(interval)
+    if index:
+        headers["X-MARS-INDEX"] = "1"
+    return headers
+
+
+def write_index(target, index, position, open_mode, log=LOG):
+    """Write the `index` received with the result in `target`, next to it."""
+    path = sidecar(target)
+    if index:
+        write_sidecar(path, index, position, append="a" in open_mode)
+        return
+
+    # The result is not GRIB, or not only, a partial index would be misleading
+    log.warning(f"No index received for {target}")
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+
+class RequestList:
+    """Requests each updating the previous one, appended to `target` in turn."""
+
+    def __init__(self, requests, target):
+        self.requests = requests
+        self.target = target
+        self.messages = []
+
+    def __iter__(self):
+        """Yield the request, open mode and position of each retrieval."""
+        req = {}
+        open_mode = "wb"
+        position = 0
+        for r in self.requests:
+            req.update(r)
+            yield req, open_mode, position
+            open_mode = "ab"
+            position = os.path.getsize(self.target)
+
+    def add(self, result):
+        """Add the messages of `result` to the previous ones, return whether to go on."""
+        self.messages.append(f"{result.message}")
+        result.message = "\n".join(self.messages)
+        return not result.error
+
+
+def open_target(target, open_mode):
+    """Open `target` to write a result, leaving the files it is linked to alone."""
+    append = "a" in open_mode
+    unshare(target, truncate=not append)
+    flags = os.O_WRONLY | os.O_CREAT
+    if not append:
+        flags |= os.O_TRUNC
+    return os.open(target, flags, 0o644)
+
+
+def raw_readinto(response):
+    """Return a `readinto` over the body of `response`, chunked framing included.
+
+    The framing is decoded by `ChunkedReader`, reading straight from the socket
+    file of http.client, which urllib3 keeps in private attributes. If they are
+    not there, the chunks decoded by urllib3 are framed again.
+    """
+    fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+    readinto = getattr(fp, "readinto", None)
+    if readinto is not None:
+        return readinto
+
+    LOG.debug("No access to the raw stream, reading the chunks from urllib3")
+    return Reframer(response.raw.read_chunked(decode_content=False)).readinto
+
+
 class RemoteMarsClientSession:
+    read_buffer_size = 1024 * 1024
+    write_buffer_size = 4 * 1024 * 1024
+
     def __init__(
         self,
         *,
@@ -77,6 +250,11 @@ class RemoteMarsClientSession:
         position=0,
         timeout=60,
         log=LOG,
+        health=None,
+        progress=None,
+        progress_interval=10,
+        stall_timeout=None,
+        index=False,
     ):
         self.url = url
         self.request = request
@@ -86,72 +264,170 @@ class RemoteMarsClientSession:
         self.endr_recieved = False
         self.timeout = timeout
         self.log = log
+        self.health = health or default_health()
         self.open_mode = open_mode
         self.position = position
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stall_timeout = stall_timeout
+        self.index = index
+        self.started = None
+        self.writer = None
+        self.cancelled = False
+        self._sockets = []
+
+    @property
+    def received(self):
+        """Number of bytes of the result received so far."""
+        return 0 if self.writer is None else self.writer.written
+
+    def cancel(self):
+        """Abort the session from another thread, by shutting down its connections."""
+        self.cancelled = True
+        for sock in list(self._sockets):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _track(self, sock):
+        self._sockets.append(sock)
+        if self.cancelled:
+            self.cancel()
+
+    def _failure(self):
+        # A cancelled session says nothing about the health of the host
+        if not self.cancelled:
+            self.health.failure(self.url)
 
     def _transfer(self, r):
         start = time.time()
-        total = 0
-        with open(self.target, self.open_mode) as f:
+
+        reader = ChunkedReader(raw_readinto(r), self.read_buffer_size)
+
+        fd = open_target(self.target, self.open_mode)
+        try:
+            writer = PositionalWriter(fd, self.position, self.write_buffer_size)
+            self.writer = writer
             self.endr_recieved = False
-            count = 0
-            for chunk in r.raw.read_chunked():
-                count += 1
-                total += len(chunk)
-                if len(chunk) == 4:
-                    if chunk == b"RWND":
-                        f.seek(self.position)
-                        f.truncate(self.position)
-                        continue
-
-                    if chunk == b"EROR":
-                        try:
-                            message = json.loads(next(r.raw.read_chunked()))
-                            LOG.error(f"Error received {message}")
-                            raise ClientError(message)
-                        except (StopIteration, json.decoder.JSONDecodeError):
-                            pass
+            index = []
 
+            for marker, payload in reader:
+                if marker is None:
+                    writer.write(payload)
+                    continue
+
+                if marker == RWND:
+                    writer.rewind()
+                    continue
+
+                if marker == EROR:
+                    try:
+                        message = json.loads(payload)
+                    except json.decoder.JSONDecodeError:
                         raise ValueError("Error received")
+                    LOG.error(f"Error received {message}")
+                    raise ClientError(message)
+
+                if marker == ENDR:
+                    self.endr_recieved = True
+                    continue
 
-                    if chunk == b"ENDR":
-                        self.endr_recieved = True
-                        continue
+                if marker == PROG:
+                    if self.progress is not None:
+                        self.progress(json.loads(payload))
+                    continue
 
-                    raise ValueError(f"Unknown message {chunk}")
+                if marker == INDX:
+                    index.append(payload)
+                    continue
 
-                f.write(chunk)
+            writer.flush()
 
             if not self.endr_recieved:
                 raise ValueError("ENDR not received")
 
+            if self.index:
+                write_index(self.target, index, self.position, self.open_mode, self.log)
+
+            total = writer.written
+        finally:
+            os.close(fd)
+            r.close()
+
         elapsed = time.time() - start
         self.log.info(
             f"Transfered {bytes(total)} in {elapsed:.1f}s, {bytes(total / elapsed)}"
         )
 
     def execute(self):
+        _LOCAL.on_socket = self._track
+        try:
+            return self._execute()
+        finally:
+            _LOCAL.on_socket = None
+            self._sockets = []
+
+    def _execute(self):
+        import requests
+        import urllib3
+
         self.log.info(f"Calling {self.url} {self.request} {self.environ}")
 
         error = None
 
+        headers = mars_headers(
+            self.progress, self.progress_interval, self.stall_timeout, self.index
+        )
+
+        posted = False
         try:
-            requests.head(self.url, timeout=self.timeout)
-            r = requests.post(
+            # No need to ping a host known to be healthy
+            if not self.health.is_healthy(self.url):
+                head = session().head(self.url, timeout=self.timeout)
+                if head.status_code == http.HTTPStatus.SERVICE_UNAVAILABLE:
+                    # The server is draining, e.g. before a restart
+                    self.log.warning(f"Host {self.url} is unavailable")
+                    self._failure()
+                    return Result(
+                        error=requests.exceptions.HTTPError(
+                            f"{head.status_code} {head.reason}", response=head
+                        ),
+                        retry_next_host=True,
+                    )
+            posted = True
+            r = session().post(
                 self.url,
                 json=dict(
                     request=self.request,
                     environ=self.environ,
                 ),
+                headers=headers,
                 stream=True,
+                timeout=(self.timeout, self.stall_timeout),
             )
         except requests.exceptions.Timeout as e:
             self.log.error(f"Timeout {e}")
+            # A host slow to answer a retrieval it took is busy, not down
+            if not (posted and isinstance(e, requests.exceptions.ReadTimeout)):
+                self._failure()
             return Result(error=e, retry_next_host=True)
         except requests.exceptions.ConnectionError as e:
             self.log.error(f"Connection error {e}")
+            self._failure()
             return Result(error=e, retry_next_host=True)
 
+        if r.status_code in (
+            http.HTTPStatus.BAD_GATEWAY,
+            http.HTTPStatus.GATEWAY_TIMEOUT,
+            http.HTTPStatus.SERVICE_UNAVAILABLE,
+        ):
+            self._failure()
+        else:
+            self.health.success(self.url)
+
+        self.started = time.time()
+
         try:
             r.raise_for_status()
         except requests.exceptions.HTTPError as e:
@@ -161,34 +437,11 @@ class RemoteMarsClientSession:
         uid = None
         code = r.status_code
         if code not in (http.HTTPStatus.BAD_REQUEST, http.HTTPStatus.OK):
-            retry_same_host = code in (
-                http.HTTPStatus.BAD_GATEWAY,
-                http.HTTPStatus.GATEWAY_TIMEOUT,
-                http.HTTPStatus.INTERNAL_SERVER_ERROR,
-                http.HTTPStatus.REQUEST_TIMEOUT,
-                http.HTTPStatus.SERVICE_UNAVAILABLE,
-            )
-
-            retry_next_host = code in (http.HTTPStatus.TOO_MANY_REQUESTS,)
-
-            if "X-MARS-SIGNAL" in r.headers:
-                signal = int(r.headers["X-MARS-SIGNAL"])
-                self.log.error(f"MARS client kill by signal {signal}")
-
-            if "X-MARS-RETRY-SAME-HOST" in r.headers:
-                retry_same_host = int(r.headers["X-MARS-RETRY-SAME-HOST"])
-
-            if "X-MARS-RETRY-NEXT-HOST" in r.headers:
-                retry_next_host = int(r.headers["X-MARS-RETRY-NEXT-HOST"])
-
-            return Result(
-                error=error,
-                message=r.text or str(error),
-                retry_same_host=retry_same_host,
-                retry_next_host=retry_next_host or retry_same_host,
-            )
+            return error_result(code, r.headers, r.text or str(error), error, self.log)
 
         uid = r.headers["X-MARS-UID"]
+        # Deleted in __del__ if the log cannot be deleted below
+        self.uid = uid
 
         if code == http.HTTPStatus.BAD_REQUEST:
             if "X-MARS-EXIT-CODE" in r.headers:
@@ -205,8 +458,12 @@ class RemoteMarsClientSession:
                     retry_same_host=e.retry_same_host,
                     retry_next_host=e.retry_next_host,
                 )
-            except urllib3.exceptions.ProtocolError as e:
+            except (urllib3.exceptions.ProtocolError, ChunkedProtocolError) as e:
                 self.log.exception("Error transferring file (ProtocolError)")
+                self._failure()
+                return Result(error=e, retry_same_host=True, retry_next_host=True)
+            except socket.timeout as e:
+                self.log.error(f"Transfer stalled for more than {self.stall_timeout}s")
                 return Result(error=e, retry_same_host=True, retry_next_host=True)
             except Exception as e:
                 self.log.exception("Error transferring file (Other errors)")
@@ -215,17 +472,17 @@ class RemoteMarsClientSession:
         logfile = None
 
         try:
-            r = requests.get(self.url + "/" + uid)
+            r = session().get(self.url + "/" + uid, timeout=self.timeout)
             r.raise_for_status()
             logfile = r.text
-        except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError):
+        except requests.exceptions.RequestException:
             self.log.exception("Error getting log file")
 
         try:
-            r = requests.delete(self.url + "/" + uid)
+            r = session().delete(self.url + "/" + uid, timeout=self.timeout)
             r.raise_for_status()
             self.uid = None
-        except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError):
+        except requests.exceptions.RequestException:
             self.log.exception("Error deleting log file")
 
         return Result(error=error, message=logfile or str(error))
@@ -233,7 +490,7 @@ class RemoteMarsClientSession:
     def __del__(self):
         try:
             if self.uid is not None:
-                requests.delete(self.url + "/" + self.uid)
+                session().delete(self.url + "/" + self.uid)
         except Exception:
             pass
 
@@ -249,6 +506,11 @@ class RemoteMarsClient:
         delay=10,
         timeout=60,
         log=LOG,
+        health=None,
+        progress=None,
+        progress_interval=10,
+        stall_timeout=None,
+        index=False,
     ):
         self.url = url
         self.retries = retries
@@ -257,6 +519,23 @@ class RemoteMarsClient:
         self.log = log
         self.open_mode = open_mode
         self.position = position
+        self.health = health
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stall_timeout = stall_timeout
+        self.index = index
+        self.session = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Abort the current session and any further retry, from another thread."""
+        self._cancelled.set()
+        if self.session is not None:
+            self.session.cancel()
 
     def execute(self, request, environ, target):
         session = RemoteMarsClientSession(
@@ -268,11 +547,17 @@ class RemoteMarsClient:
             open_mode=self.open_mode,
             position=self.position,
             log=self.log,
+            health=self.health,
+            progress=self.progress,
+            progress_interval=self.progress_interval,
+            stall_timeout=self.stall_timeout,
+            index=self.index,
         )
+        self.session = session
 
         for i in range(self.retries):
             reply = session.execute()
-            if not reply.error:
+            if not reply.error or self.cancelled:
                 return reply
 
             if not reply.retry_same_host:
@@ -281,74 +566,183 @@ class RemoteMarsClient:
             self.log.error(f"Error {reply}")
             self.log.error(f"Retry on the same host {self.url}")
 
-            time.sleep(self.delay)
+            if self._cancelled.wait(backoff(self.delay, i)):
+                return reply
 
         return reply
 
 
 class RemoteMarsClientCluster:
-    def __init__(self, urls, retries=3, delay=10, timeout=60, log=LOG):
+    def __init__(
+        self,
+        urls,
+        retries=3,
+        delay=10,
+        timeout=60,
+        log=LOG,
+        health=None,
+        probe=False,
+        hedge_after=None,
+        hedge_min_rate=None,
+        hedge_budget=0.1,
+        progress=None,
+        progress_interval=10,
+        stall_timeout=None,
+        index=False,
+        stripes=None,
+        cache=None,
+    ):
         self.urls = urls
         self.retries = retries
         self.delay = delay
         self.timeout = timeout
         self.log = log
+        self.health = health or default_health()
+        self.probe = probe
+        # Hedging is enabled by setting `hedge_after`, see the `hedging` module
+        self.hedge_after = hedge_after
+        self.hedge_min_rate = hedge_min_rate
+        self.hedge_budget = hedge_budget
+        # `progress` is called with the progress reports of the server, and
+        # `stall_timeout` is the longest silence tolerated, progress included
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.stall_timeout = stall_timeout
+        # With `index`, the index of the GRIB messages of the result is written
+        # next to the target, see the `gribindex` module
+        self.index = index
+        # With `stripes`, large requests are split and retrieved from as many
+        # hosts concurrently, see the `striping` module
+        self.stripes = stripes
+        # A `cache.ResultCache` shared with the other workers of the host
+        self.cache = cache
 
     def execute(self, request, environ, target):
-        if isinstance(request, dict):
-            return self._execute(request, environ, target, "wb", 0)
-
-        req = {}
-        open_mode = "wb"
-        position = 0
-        messages = []
-
-        for r in request:
-            req.update(r)
-
-            result = self._execute(
-                req, environ, target, open_mode=open_mode, position=position
+        if self.cache is not None:
+            return self.cache.execute(
+                request,
+                target,
+                lambda path: self._execute_all(request, environ, path),
+                index=self.index,
             )
-            messages.append(f"{result.message}")
+        return self._execute_all(request, environ, target)
 
-            if result.error:
-                result.message = "\n".join(messages)
-                return result
-
-            open_mode = "ab"
-            position = os.path.getsize(target)
+    def _execute_all(self, request, environ, target):
+        if isinstance(request, dict):
+            return self._execute(request, environ, target, "wb", 0)
 
-        result.message = "\n".join(messages)
+        requests = RequestList(request, target)
+        for req, open_mode, position in requests:
+            result = self._execute(req, environ, target, open_mode, position)
+            if not requests.add(result):
+                break
         return result
 
     def _execute(self, request, environ, target, open_mode, position):
-        random.shuffle(self.urls)
+        import setproctitle
+
+        if self.probe:
+            self.health.start_probing(timeout=self.timeout)
+
         saved = setproctitle.getproctitle()
         # request_id = environ.get("request_id", "unknown")
         try:
-            for url in self.urls:
-                # setproctitle.setproctitle(f"cads_mars_client {request_id} {url}")
-
-                client = RemoteMarsClient(
-                    url=url,
-                    retries=self.retries,
-                    delay=self.delay,
-                    timeout=self.timeout,
-                    open_mode=open_mode,
-                    position=position,
-                    log=self.log,
+            urls = self.health.order(self.urls)
+            reply = None
+
+            if self.stripes and len(urls) > 1:
+                from . import striping
+
+                stripes = striping.split(request, min(self.stripes, len(urls)))
+                if len(stripes) > 1:
+                    return striping.execute(
+                        self, urls, stripes, environ, target, open_mode, position
+                    )
+
+            # A primary whose trial request is taken is left to the failover
+            if (
+                self.hedge_after is not None
+                and len(urls) > 1
+                and self.health.acquire(urls[0])
+            ):
+                from . import hedging
+
+                reply, urls = hedging.execute(
+                    self, urls, request, environ, target, open_mode, position
                 )
-
-                reply = client.execute(request, environ, target)
-                if not reply.error:
-                    return reply
-
-                if not reply.retry_next_host:
+                if not reply.error or not reply.retry_next_host:
                     return reply
 
                 self.log.error(f"Error {reply}")
-                self.log.error(f"Retry on the next host {url}")
+                self.log.error("Retry on the next host")
+
+            return self.failover(
+                urls, request, environ, target, open_mode, position, reply
+            )
         finally:
             setproctitle.setproctitle(saved)
 
+    def failover(
+        self,
+        urls,
+        request,
+        environ,
+        target,
+        open_mode,
+        position,
+        reply=None,
+        on_client=None,
+    ):
+        """Execute `request` on the first of `urls` that can, in order.
+
+        `on_client` is called with each client before it runs, e.g. to be able
+        to cancel it.
+        """
+        for url in self.usable(urls):
+            # setproctitle.setproctitle(f"cads_mars_client {request_id} {url}")
+
+            client = self.client(url, open_mode, position)
+            if on_client is not None:
+                on_client(client)
+
+            reply = client.execute(request, environ, target)
+            if not reply.error or client.cancelled:
+                return reply
+
+            if not reply.retry_next_host:
+                return reply
+
+            self.log.error(f"Error {reply}")
+            self.log.error(f"Retry on the next host {url}")
+
         return reply
+
+    def usable(self, urls):
+        """Yield `urls`, taking the trial request of the recovering hosts.
+
+        Hosts that cannot be tried, open or with their trial request taken by
+        another request, are only yielded last, as a last resort.
+        """
+        deferred = []
+        for url in urls:
+            if self.health.acquire(url):
+                yield url
+            else:
+                deferred.append(url)
+        yield from deferred
+
+    def client(self, url, open_mode, position):
+        return RemoteMarsClient(
+            url=url,
+            retries=self.retries,
+            delay=self.delay,
+            timeout=self.timeout,
+            open_mode=open_mode,
+            position=position,
+            log=self.log,
+            health=self.health,
+            progress=self.progress,
+            progress_interval=self.progress_interval,
+            stall_timeout=self.stall_timeout,
+            index=self.index,
+        )
@@ -0,0 +1,255 @@
+"""Index of the GRIB messages of a result, built by the server as it is relayed.
+
+Clients asking for it (with the ``X-MARS-INDEX`` header) get ``INDX`` markers
+after ``ENDR``, whose payloads are JSON lines, one per GRIB message, with its
+offset and length in the result and a few keys from its headers. The client
+writes them next to the target (see `sidecar`), so that the result can be
+subset without being read again.
+
+Only the first sections of each message are looked at, the data is skipped.
+Offsets are relative to the start of the result, and are reset when MARS
+rewinds its output.
+"""
+
+import json
+import logging
+
+from .chunked import RWND
+from .tools import unshare
+
+LOG = logging.getLogger(__name__)
+
+# The first sections of a message must fit in this, or there will be no index
+MAX_HEAD_SIZE = 64 * 1024
+
+PAYLOAD_SIZE = 64 * 1024
+
+
+def sidecar(target):
+    """Return the path of the index of `target`."""
+    return f"{target}.index"
+
+
+def _int(data, offset, size):
+    return int.from_bytes(data[offset : offset + size], "big")
+
+
+def _signed(data, offset, size):
+    # GRIB stores negative numbers as sign and magnitude
+    value = _int(data, offset, size)
+    sign = 1 << (8 * size - 1)
+    return -(value & ~sign) if value & sign else value
+
+
+def _grib1(head, length):
+    """Return the total length and the keys of a GRIB 1 message, or the bytes needed."""
+    if len(head) < 8 + 28:
+        return 8 + 28
+
+    section1 = 8
+    size = _int(head, section1, 3)
+    flag = head[section1 + 7]
+    table, number = head[section1 + 3], head[section1 + 8]
+    level_type = head[section1 + 9]
+    if level_type in (100, 103, 105, 107, 109, 111, 113, 115, 117, 119, 125, 160):
+        level = _int(head, section1 + 10, 2)
+    else:
+        level = head[section1 + 10]
+    century = head[section1 + 24]
+    year = (century - 1) * 100 + head[section1 + 12]
+
+    if length & 0x800000:
+        # Messages of more than 8 MiB have their length in units of 120 bytes,
+        # the difference being given by the length of section 4
+        offset = section1 + size
+        for present in (flag & 0x80, flag & 0x40):
+            if present:
+                if len(head) < offset + 3:
+                    return offset + 3
+                offset += _int(head, offset, 3)
+        if len(head) < offset + 3:
+            return offset + 3
+        section4 = _int(head, offset, 3)
+        if section4 < 120:
+            length = (length & 0x7FFFFF) * 120 - section4 + 4
+
+    return length, dict(
+        param=f"{number}.{table}",
+        date=year * 10000 + head[section1 + 13] * 100 + head[section1 + 14],
+        time=head[section1 + 15] * 100 + head[section1 + 16],
+        levtype=level_type,
+        level=level,
+    )
+
+
+def _grib2(head, length):
+    """Return the total length and the keys of a GRIB 2 message, or the bytes needed."""
+    offset = 16
+    keys = dict(param=None, date=None, time=None, levtype=None, level=None)
+    while True:
+        if len(head) < offset + 5:
+            return offset + 5
+        if head[offset : offset + 4] == b"7777":
+            return length, keys
+
+        size = _int(head, offset, 4)
+        number = head[offset + 4]
+        if size < 5:
+            raise ValueError(f"Invalid GRIB 2 section {number} of {size} bytes")
+
+        if number == 1:
+            if len(head) < offset + 19:
+                return offset + 19
+            keys["date"] = (
+                _int(head, offset + 12, 2) * 10000
+                + head[offset + 14] * 100
+                + head[offset + 15]
+            )
+            keys["time"] = head[offset + 16] * 100 + head[offset + 17]
+
+        if number == 4:
+            if len(head) < offset + 28:
+                return offset + 28
+            keys["param"] = f"{head[6]}.{head[offset + 9]}.{head[offset + 10]}"
+            # The first fixed surface is at the same place in the usual templates
+            if _int(head, offset + 7, 2) < 16:
+                keys["levtype"] = head[offset + 22]
+                value = _signed(head, offset + 24, 4)
+                scale = _signed(head, offset + 23, 1)
+                keys["level"] = value if scale == 0 else value / 10**scale
+            return length, keys
+
+        if number >= 5:
+            return length, keys
+
+        offset += size
+
+
+def parse(head):
+    """Return the length and the keys of the GRIB message starting `head`.
+
+    Returns the number of bytes of the message needed instead, if `head` is
+    too short. Raises ValueError if `head` does not start with a GRIB message.
+    """
+    if len(head) < 16:
+        return 16
+    if head[:4] != b"GRIB":
+        raise ValueError("Not a GRIB message")
+
+    edition = head[7]
+    if edition == 1:
+        return _grib1(head, _int(head, 4, 3))
+    if edition == 2:
+        return _grib2(head, _int(head, 8, 8))
+    raise ValueError(f"Unsupported GRIB edition {edition}")
+
+
+class GribIndexer:
+    """Index the GRIB messages of the data chunks of a MARS stream.
+
+    `on_chunk` is meant to be passed to `ChunkScanner`. Data that is not GRIB
+    (or an unexpected error) disables the index for the rest of the stream.
+    """
+
+    def __init__(self):
+        self.marker = b""
+        self.rewind()
+
+    def rewind(self):
+        self.messages = []
+        self.valid = True
+        self.offset = 0
+        self.head = bytearray()
+        self.start = 0
+        self.skip = 0
+        self.need = 16
+
+    def on_chunk(self, data, size):
+        # Four bytes chunks are the control markers
+        if size == 4:
+            self.marker += bytes(data)
+            if len(self.marker) == 4:
+                if self.marker == RWND:
+                    self.rewind()
+                self.marker = b""
+            return
+
+        if self.valid:
+            try:
+                self.feed(data)
+            except Exception as e:
+                LOG.warning(f"Cannot index GRIB at offset {self.start:,}: {e}")
+                self.valid = False
+                self.messages = []
+
+    def feed(self, data):
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if self.skip:
+                n = min(self.skip, end - pos)
+                self.skip -= n
+                pos += n
+                self.offset += n
+                continue
+
+            n = min(self.need - len(self.head), end - pos)
+            if not self.head:
+                self.start = self.offset
+            self.head += data[pos : pos + n]
+            pos += n
+            self.offset += n
+
+            if len(self.head) < self.need:
+                continue
+
+            result = parse(self.head)
+            if isinstance(result, int):
+                if result > MAX_HEAD_SIZE:
+                    raise ValueError(
+                        f"GRIB headers of more than {MAX_HEAD_SIZE:,} bytes"
+                    )
+                self.need = result
+                continue
+
+            length, keys = result
+            if length < len(self.head):
+                raise ValueError(f"Invalid GRIB message length {length}")
+            self.messages.append(dict(offset=self.start, length=length, **keys))
+            self.skip = length - len(self.head)
+            self.head = bytearray()
+            self.need = 16
+
+    @property
+    def complete(self):
+        """True if the data seen so far is made of whole GRIB messages."""
+        return self.valid and not self.head and not self.skip
+
+    def payloads(self, size=PAYLOAD_SIZE):
+        """Yield the index as JSON lines, in payloads of about `size` bytes."""
+        if not self.complete:
+            return
+
+        payload = []
+        length = 0
+        for message in self.messages:
+            line = json.dumps(message, separators=(",", ":")) + "\n"
+            payload.append(line)
+            length += len(line)
+            if length >= size:
+                yield "".join(payload).encode()
+                payload = []
+                length = 0
+        if payload:
+            yield "".join(payload).encode()
+
+
+def write_sidecar(path, payloads, position=0, append=False):
+    """Write the index received in `payloads`, shifting offsets by `position`."""
+    unshare(path, truncate=not append)
+    with open(path, "a" if append else "w") as f:
+        for payload in payloads:
+            for line in payload.decode().splitlines():
+                message = json.loads(line)
+                message["offset"] += position
+                f.write(json.dumps(message, separators=(",", ":")) + "\n")
@@ -0,0 +1,223 @@
+"""Health of the MARS servers, as seen by the clients.
+
+Each host has a circuit breaker. It is ``closed`` while the host answers,
+``open`` after `threshold` consecutive failures, in which case the host is
+avoided for a cooldown that grows exponentially, with jitter, with the number
+of failures. Once the cooldown has expired the breaker is ``half-open``: a
+single request (or background probe) is let through, and its outcome closes
+or re-opens the breaker.
+
+The state is kept per process and can be shared by all the worker processes
+of a node through a JSON file, set with ``CADS_MARS_SERVER_HEALTH_FILE``.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+HEALTH_FILE_ENV = "CADS_MARS_SERVER_HEALTH_FILE"
+
+
+def backoff(delay, attempt, maximum=None):
+    """Return the delay before the `attempt`-th retry (from 0), with jitter."""
+    value = delay * 2**attempt
+    if maximum is not None:
+        value = min(value, maximum)
+    return random.uniform(value / 2, value)
+
+
+class HostHealth:
+    def __init__(
+        self,
+        path=None,
+        threshold=1,
+        cooldown=10,
+        max_cooldown=600,
+        ttl=60,
+        trial_timeout=60,
+    ):
+        self.path = path
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.ttl = ttl
+        self.trial_timeout = trial_timeout
+        self.hosts = {}
+        self.lock = threading.RLock()
+        self._mtime = None
+        self._prober = None
+
+    def _read(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            with open(self.path) as f:
+                self.hosts = json.load(f)
+            self._mtime = mtime
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            LOG.exception(f"Cannot read host health from {self.path}")
+
+    def _write(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.hosts, f)
+        os.replace(tmp, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    @contextlib.contextmanager
+    def _shared(self, exclusive):
+        with self.lock:
+            if self.path is None:
+                yield
+                return
+
+            fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                self._read()
+                yield
+                if exclusive:
+                    self._write()
+            finally:
+                os.close(fd)
+
+    def _entry(self, url):
+        return self.hosts.setdefault(
+            url, dict(state=CLOSED, failures=0, until=0, checked=0)
+        )
+
+    def _state(self, entry):
+        if entry["state"] == CLOSED:
+            return CLOSED
+        if time.time() < entry["until"]:
+            return OPEN
+        return HALF_OPEN
+
+    def state(self, url):
+        """Return the state of the breaker of `url`, or None if unknown."""
+        with self._shared(exclusive=False):
+            entry = self.hosts.get(url)
+            return None if entry is None else self._state(entry)
+
+    def is_healthy(self, url):
+        """Return True if `url` answered recently, so it does not need a ping."""
+        with self._shared(exclusive=False):
+            entry = self.hosts.get(url)
+            return (
+                entry is not None
+                and entry["state"] == CLOSED
+                and time.time() - entry["checked"] < self.ttl
+            )
+
+    def acquire(self, url):
+        """Return True if a request may be sent to `url` now.
+
+        When the breaker is half-open, this takes the single trial request.
+        """
+        with self._shared(exclusive=True):
+            entry = self._entry(url)
+            state = self._state(entry)
+            if state == HALF_OPEN:
+                LOG.info(f"Trying {url} again")
+                entry["state"] = HALF_OPEN
+                entry["until"] = time.time() + self.trial_timeout
+            return state != OPEN
+
+    def success(self, url):
+        with self._shared(exclusive=True):
+            entry = self._entry(url)
+            if entry["state"] != CLOSED:
+                LOG.info(f"Host {url} is healthy again")
+            entry.update(state=CLOSED, failures=0, until=0, checked=time.time())
+
+    def failure(self, url):
+        with self._shared(exclusive=True):
+            entry = self._entry(url)
+            entry["failures"] += 1
+            entry["checked"] = 0
+            if entry["failures"] >= self.threshold or entry["state"] != CLOSED:
+                cooldown = backoff(
+                    self.cooldown,
+                    max(0, entry["failures"] - self.threshold),
+                    self.max_cooldown,
+                )
+                LOG.warning(f"Avoiding host {url} for {cooldown:.1f}s")
+                entry.update(state=OPEN, until=time.time() + cooldown)
+
+    def order(self, urls):
+        """Return `urls` shuffled, healthy hosts first and open ones last."""
+        with self._shared(exclusive=False):
+            groups = {CLOSED: [], HALF_OPEN: [], OPEN: []}
+            for url in urls:
+                entry = self.hosts.get(url)
+                groups[CLOSED if entry is None else self._state(entry)].append(url)
+
+            for group in groups.values():
+                random.shuffle(group)
+
+            # Open hosts are only used as a last resort, soonest to recover first
+            groups[OPEN].sort(key=lambda url: self.hosts[url]["until"])
+
+            return groups[CLOSED] + groups[HALF_OPEN] + groups[OPEN]
+
+    def _probe(self, interval, timeout):
+        from .client import session
+
+        while True:
+            time.sleep(interval)
+            with self._shared(exclusive=False):
+                due = [
+                    url
+                    for url, entry in self.hosts.items()
+                    if self._state(entry) == HALF_OPEN
+                ]
+
+            for url in due:
+                if not self.acquire(url):
+                    continue
+                try:
+                    session().head(url, timeout=timeout).raise_for_status()
+                except Exception as e:
+                    LOG.warning(f"Probe of {url} failed: {e}")
+                    self.failure(url)
+                else:
+                    self.success(url)
+
+    def start_probing(self, interval=5, timeout=10):
+        """Probe hosts in the background as soon as their cooldown expires."""
+        with self.lock:
+            # Threads do not survive a fork, so check it is really running
+            if self._prober is not None and self._prober.is_alive():
+                return
+            self._prober = threading.Thread(
+                target=self._probe,
+                args=(interval, timeout),
+                name="cads-mars-health-probe",
+                daemon=True,
+            )
+            self._prober.start()
+
+
+_HEALTH = None
+
+
+def default_health():
+    """Return the process-wide `HostHealth`."""
+    global _HEALTH
+    if _HEALTH is None:
+        _HEALTH = HostHealth(path=os.environ.get(HEALTH_FILE_ENV))
+    return _HEALTH
@@ -0,0 +1,187 @@
+"""Hedged requests, to cut the tail latency caused by stalled MARS servers.
+
+A MARS server can be alive but stalled (e.g. waiting for a tape mount), in
+which case failing over only happens at the timeout. When hedging is enabled,
+a request that has not received its first byte after ``hedge_after`` seconds,
+or whose throughput over ``hedge_after`` seconds falls below
+``hedge_min_rate`` bytes per second, is duplicated on the next host. The first
+attempt to succeed wins and the other one is cancelled by closing its
+connection, which makes the server kill its MARS process.
+
+The primary attempt writes to the target, the hedge to a scratch file which
+is moved into place if it wins. The extra load is capped by a process-wide
+budget: each request earns ``hedge_budget`` hedges, so that in the long run
+at most that fraction of the requests are duplicated.
+"""
+
+import contextlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+from .client import Result
+from .gribindex import sidecar, write_sidecar
+from .tools import unshare
+
+LOG = logging.getLogger(__name__)
+
+POLL = 0.2
+
+
+class HedgeBudget:
+    def __init__(self, tokens=1.0, max_tokens=10.0):
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self, ratio):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+BUDGET = HedgeBudget()
+
+
+class Attempt(threading.Thread):
+    def __init__(self, client, request, environ, target):
+        super().__init__(name=f"cads-mars-attempt {client.url}", daemon=True)
+        self.client = client
+        self.request = request
+        self.environ = environ
+        self.target = target
+        self.reply = None
+        self.launched = time.time()
+
+    @property
+    def url(self):
+        return self.client.url
+
+    def run(self):
+        try:
+            self.reply = self.client.execute(self.request, self.environ, self.target)
+        except Exception as e:
+            LOG.exception(f"Error executing request on {self.url}")
+            self.reply = Result(error=e, retry_next_host=True)
+
+    def cancel(self):
+        self.client.cancel()
+        self.join()
+
+
+class Monitor:
+    """Tell whether an attempt is stalled."""
+
+    def __init__(self, attempt, after, min_rate):
+        self.attempt = attempt
+        self.after = after
+        self.min_rate = min_rate
+        self.sample_time = None
+        self.sample_bytes = 0
+
+    def stalled(self):
+        now = time.time()
+        session = self.attempt.client.session
+        # Progress reports from the server do not count as data
+        if session is None or session.started is None or not session.received:
+            return now - self.attempt.launched > self.after
+
+        if self.min_rate is None:
+            return False
+
+        if self.sample_time is None:
+            self.sample_time = now
+            return False
+
+        if now - self.sample_time < self.after:
+            return False
+
+        received = session.received
+        rate = (received - self.sample_bytes) / (now - self.sample_time)
+        self.sample_time = now
+        self.sample_bytes = received
+        return rate < self.min_rate
+
+
+def deliver(scratch, target, open_mode, position):
+    if os.path.exists(sidecar(scratch)):
+        with open(sidecar(scratch), "rb") as f:
+            write_sidecar(sidecar(target), [f.read()], position, "a" in open_mode)
+
+    if "a" not in open_mode:
+        os.replace(scratch, target)
+        return
+
+    unshare(target)
+    with open(scratch, "rb") as src, open(target, "r+b") as dst:
+        dst.truncate(position)
+        dst.seek(position)
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def execute(cluster, urls, request, environ, target, open_mode, position):
+    """Execute `request` on ``urls[0]``, hedged on the next host if it stalls.
+
+    Returns the reply and the hosts left to fail over to.
+    """
+    BUDGET.deposit(cluster.hedge_budget)
+
+    remaining = list(urls[1:])
+    primary = Attempt(
+        cluster.client(urls[0], open_mode, position), request, environ, target
+    )
+    monitor = Monitor(primary, cluster.hedge_after, cluster.hedge_min_rate)
+    scratch = f"{target}.hedge"
+    hedge = None
+
+    primary.start()
+    try:
+        while primary.is_alive():
+            primary.join(POLL)
+
+            if hedge is None and remaining and primary.is_alive() and monitor.stalled():
+                if not BUDGET.withdraw():
+                    LOG.warning("Hedging budget exhausted, not hedging")
+                    monitor.after = float("inf")
+                    continue
+
+                # Not on hosts that cannot be tried
+                url = next((u for u in remaining if cluster.health.acquire(u)), None)
+                if url is None:
+                    monitor.after = float("inf")
+                    continue
+                remaining.remove(url)
+                LOG.warning(f"Request stalled on {primary.url}, hedging on {url}")
+                hedge = Attempt(cluster.client(url, "wb", 0), request, environ, scratch)
+                hedge.start()
+
+            if hedge is not None and not hedge.is_alive() and not hedge.reply.error:
+                LOG.info(f"Hedged request on {hedge.url} won over {primary.url}")
+                primary.cancel()
+                deliver(scratch, target, open_mode, position)
+                return hedge.reply, remaining
+
+        reply = primary.reply
+        if hedge is not None:
+            if reply.error and reply.retry_next_host:
+                hedge.join()
+                if not hedge.reply.error:
+                    LOG.info(f"Hedged request on {hedge.url} succeeded")
+                    deliver(scratch, target, open_mode, position)
+                    return hedge.reply, remaining
+            else:
+                hedge.cancel()
+
+        return reply, remaining
+    finally:
+        for path in (scratch, sidecar(scratch)):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
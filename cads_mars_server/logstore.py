@@ -0,0 +1,252 @@
+"""Storage of the MARS logs on the server.
+
+Logs are spread over up to 256 subdirectories of the log directory, named
+after the hash of the request uid and created as needed, so that no directory
+grows huge. A janitor process removes the logs older than ``max_age`` seconds,
+and the oldest ones when their total size exceeds ``max_size`` bytes, which
+also takes care of the logs clients never deleted.
+
+Optionally, the logs of recently finished requests are kept in a `LogCache`,
+a ring of fixed-size slots in memory shared by all the forked handlers, so
+that fetching them does not touch the disk.
+"""
+
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import signal
+import struct
+import time
+
+LOG = logging.getLogger(__name__)
+
+SHARD = re.compile(r"^[0-9a-f]{2}$")
+
+# Only the files of the server, named after the request uid, are cleaned up;
+# the profiles of slow requests are kept next to their logs
+FILE = re.compile(r"^[0-9a-f-]{36}\.(log|profile)$")
+
+
+class LogCache:
+    """A ring of logs in anonymous shared memory, inherited by forked processes.
+
+    Each slot holds a sequence number, which is odd while the slot is being
+    written, so that readers never need the lock.
+    """
+
+    HEADER = struct.Struct("=Q36sI")
+    COUNTER = struct.Struct("=Q")
+
+    def __init__(self, slots=256, slot_size=64 * 1024):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = self.HEADER.size + slot_size
+        self.memory = mmap.mmap(-1, self.COUNTER.size + slots * self.stride)
+        self.lock = multiprocessing.Lock()
+
+    def _offset(self, slot):
+        return self.COUNTER.size + slot * self.stride
+
+    def _key(self, uid):
+        key = uid.encode()
+        return key if len(key) == 36 else None
+
+    def _find(self, key):
+        for slot in range(self.slots):
+            offset = self._offset(slot)
+            seq, uid, length = self.HEADER.unpack_from(self.memory, offset)
+            if uid == key:
+                return slot, seq, length
+        return None, None, None
+
+    def put(self, uid, data):
+        key = self._key(uid)
+        if key is None or len(data) > self.slot_size:
+            return False
+
+        with self.lock:
+            (counter,) = self.COUNTER.unpack_from(self.memory, 0)
+            self.COUNTER.pack_into(self.memory, 0, counter + 1)
+
+            offset = self._offset(counter % self.slots)
+            (seq,) = self.COUNTER.unpack_from(self.memory, offset)
+            self.COUNTER.pack_into(self.memory, offset, seq + 1)
+            start = offset + self.HEADER.size
+            self.memory[start : start + len(data)] = data
+            self.HEADER.pack_into(self.memory, offset, seq + 2, key, len(data))
+
+        return True
+
+    def get(self, uid):
+        key = self._key(uid)
+        if key is None:
+            return None
+
+        slot, seq, length = self._find(key)
+        if slot is None or seq % 2:
+            return None
+
+        offset = self._offset(slot)
+        start = offset + self.HEADER.size
+        data = self.memory[start : start + length]
+
+        # Check the slot was not reused while reading it
+        if self.HEADER.unpack_from(self.memory, offset)[:2] != (seq, key):
+            return None
+        return data
+
+    def discard(self, uid):
+        key = self._key(uid)
+        if key is None:
+            return
+
+        with self.lock:
+            slot, seq, _ = self._find(key)
+            if slot is not None:
+                self.HEADER.pack_into(self.memory, self._offset(slot), seq + 2, b"", 0)
+
+
+class LogStore:
+    def __init__(self, logdir, max_age=None, max_size=None, cache=None):
+        self.logdir = logdir
+        self.max_age = max_age
+        self.max_size = max_size
+        self.cache = cache
+        self.janitor = None
+
+    def path(self, uid):
+        shard = hashlib.md5(uid.encode()).hexdigest()[:2]
+        return os.path.join(self.logdir, shard, f"{uid}.log")
+
+    def create(self, uid):
+        """Return the path of the log of a new request, creating its subdirectory."""
+        path = self.path(uid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def finished(self, uid):
+        """Keep the log of a finished request in the cache, if any."""
+        if self.cache is None:
+            return
+        try:
+            with open(self.path(uid), "rb") as f:
+                data = f.read(self.cache.slot_size + 1)
+        except FileNotFoundError:
+            return
+        self.cache.put(uid, data)
+
+    def read(self, uid):
+        """Return the log of `uid`, or None if there is none."""
+        if self.cache is not None:
+            data = self.cache.get(uid)
+            if data is not None:
+                return data
+        try:
+            with open(self.path(uid), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, uid):
+        if self.cache is not None:
+            self.cache.discard(uid)
+        try:
+            os.unlink(self.path(uid))
+        except FileNotFoundError:
+            pass
+
+    def _files(self):
+        # Logs written before sharding was introduced are cleaned up too
+        directories = [self.logdir]
+        directories += [
+            e.path
+            for e in os.scandir(self.logdir)
+            if e.is_dir() and SHARD.match(e.name)
+        ]
+        for directory in directories:
+            for entry in os.scandir(directory):
+                if not FILE.match(entry.name):
+                    continue
+                if entry.is_file(follow_symlinks=False):
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, entry.path
+
+    def clean(self, now=None):
+        """Remove logs according to `max_age` and `max_size`, return how many."""
+        now = time.time() if now is None else now
+        removed = 0
+        files = []
+
+        for mtime, size, path in self._files():
+            if self.max_age is not None and now - mtime > self.max_age:
+                removed += self._remove(path)
+            else:
+                files.append((mtime, size, path))
+
+        if self.max_size is not None:
+            total = sum(size for _, size, _ in files)
+            files.sort()
+            while files and total > self.max_size:
+                _, size, path = files.pop(0)
+                removed += self._remove(path)
+                total -= size
+
+        return removed
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+
+    def start_janitor(self, interval=60, after_fork=None):
+        """Fork a process cleaning up the logs every `interval` seconds."""
+        if self.max_age is None and self.max_size is None:
+            return
+
+        parent = os.getpid()
+        pid = os.fork()
+        if pid:
+            self.janitor = pid
+            return
+
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if after_fork is not None:
+                after_fork()
+
+            due = 0.0
+            # Stop when the server goes away
+            while os.getppid() == parent:
+                if time.time() >= due:
+                    start = time.time()
+                    due = start + interval
+                    try:
+                        removed = self.clean()
+                        if removed:
+                            LOG.info(
+                                f"Janitor removed {removed:,} logs"
+                                f" in {time.time() - start:.1f}s"
+                            )
+                    except Exception:
+                        LOG.exception("Error cleaning up logs")
+                time.sleep(1)
+        finally:
+            os._exit(0)
+
+    def stop_janitor(self):
+        if self.janitor is None:
+            return
+        try:
+            os.kill(self.janitor, signal.SIGTERM)
+            os.waitpid(self.janitor, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+        self.janitor = None
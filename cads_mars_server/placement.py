@@ -0,0 +1,172 @@
+"""Placement of the retrievals on the CPUs of the node, and their priorities.
+
+With a placement policy, each handler is pinned to a set of CPUs before it
+starts MARS, which inherits it, so that both ends of the pipe share their
+caches. The sets are given to the retrievals in turn:
+
+``numa``
+    the CPUs of a NUMA node, round-robin over the nodes.
+``cores``
+    groups of ``size`` CPUs, never spanning two NUMA nodes.
+
+Requests can also be given a class, read from a field of ``environ``, which
+sets the niceness and the I/O priority of their MARS process (e.g. so that
+retrievals from tape do not compete with the relays for the disks). I/O
+priorities are written as ``idle``, ``be/N`` or ``rt/N``, as with ``ionice``.
+"""
+
+import ctypes
+import glob
+import logging
+import multiprocessing
+import os
+import platform
+import re
+
+LOG = logging.getLogger(__name__)
+
+POLICIES = ("none", "numa", "cores")
+
+IOPRIO_CLASSES = {"rt": 1, "be": 2, "idle": 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# Not exposed by the os module
+SYS_IOPRIO_SET = {
+    "x86_64": 251,
+    "aarch64": 30,
+    "ppc64le": 273,
+    "s390x": 282,
+    "i686": 289,
+}
+
+
+def parse_cpulist(text):
+    """Return the CPUs of a list such as ``0-3,8,10-11``, as a set."""
+    cpus = set()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def numa_nodes():
+    """Return the CPUs this process may run on, as a list of sets, one per node."""
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    for path in sorted(
+        glob.glob("/sys/devices/system/node/node*/cpulist"),
+        key=lambda p: int(re.search(r"node(\d+)", p).group(1)),
+    ):
+        with open(path) as f:
+            cpus = parse_cpulist(f.read()) & allowed
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [allowed]
+
+
+class Placement:
+    def __init__(self, policy="none", size=2):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown placement policy {policy!r}")
+
+        self.policy = policy
+        self.groups = []
+        # Number of retrievals placed, shared by the forked handlers
+        self.count = multiprocessing.Value("Q", 0)
+
+        if policy == "numa":
+            self.groups = numa_nodes()
+
+        if policy == "cores":
+            for cpus in numa_nodes():
+                cpus = sorted(cpus)
+                self.groups += [
+                    set(cpus[i : i + size]) for i in range(0, len(cpus), size)
+                ]
+
+        if self.groups:
+            LOG.info(f"Placing retrievals on {len(self.groups)} sets of CPUs")
+
+    def next(self):
+        """Return the number of a new retrieval."""
+        with self.count.get_lock():
+            n = self.count.value
+            self.count.value += 1
+        return n
+
+    def apply(self, n=None):
+        """Pin this process to the CPUs of the `n`-th retrieval, or of a new one."""
+        if not self.groups:
+            return
+        if n is None:
+            n = self.next()
+        cpus = self.groups[n % len(self.groups)]
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            LOG.warning(f"Cannot run on CPUs {sorted(cpus)}: {e}")
+
+
+def parse_ioprio(text):
+    """Return the value of the I/O priority `text`, as given to ``ioprio_set``."""
+    name, _, level = text.strip().lower().partition("/")
+    if name not in IOPRIO_CLASSES:
+        raise ValueError(f"Invalid I/O priority {text!r}")
+    level = int(level or 4) if name != "idle" else 0
+    if not 0 <= level <= 7:
+        raise ValueError(f"Invalid I/O priority {text!r}")
+    return IOPRIO_CLASSES[name] << IOPRIO_CLASS_SHIFT | level
+
+
+def set_ioprio(value, pid=0):
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError(f"ioprio_set is not known on {platform.machine()}")
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, pid, value) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+class Priorities:
+    """Niceness and I/O priority of the MARS processes, by request class.
+
+    `classes` maps the values of the ``key`` field of ``environ`` to a
+    ``(nice, ioprio)`` tuple, either of which can be None. The ``default``
+    class applies to the other requests.
+    """
+
+    def __init__(self, key, classes):
+        self.key = key
+        self.classes = classes
+
+    @classmethod
+    def from_options(cls, key, options):
+        """Parse options such as ``archive=10,idle``, ``interactive=,be/0``."""
+        classes = {}
+        for option in options:
+            name, _, value = option.partition("=")
+            nice, _, ioprio = value.partition(",")
+            classes[name.strip()] = (
+                int(nice) if nice.strip() else None,
+                parse_ioprio(ioprio) if ioprio.strip() else None,
+            )
+        return cls(key, classes)
+
+    def lookup(self, environ):
+        name = environ.get(self.key)
+        return self.classes.get(str(name), self.classes.get("default", (None, None)))
+
+    def apply(self, environ):
+        """Set the priorities of the request of `environ` for this process."""
+        nice, ioprio = self.lookup(environ)
+        try:
+            if nice is not None:
+                os.nice(nice - os.nice(0))
+            if ioprio is not None:
+                set_ioprio(ioprio)
+        except OSError as e:
+            LOG.warning(f"Cannot set the priorities nice={nice} ioprio={ioprio}: {e}")
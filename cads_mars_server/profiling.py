@@ -0,0 +1,156 @@
+"""Profiling of the relay loop, and a flight recorder of the slow requests.
+
+When profiling is enabled, a sample of the requests (``sample``, between 0
+and 1) records the events of their relay loop: each wake-up of ``select``
+with the time waited, each ``os.read`` with its size, and each write to the
+client with its size and duration. Events go into a `FlightRecorder`, a
+fixed-size ring of preallocated arrays, so recording allocates nothing and
+only the last ``size`` events are kept; totals are kept over all of them.
+
+Requests taking more than ``threshold`` seconds have their record written
+next to their log, together with the resource usage of their MARS process
+(from ``os.wait4``) and of their relay, so that a slow retrieval can be told
+MARS-bound (MARS busy, relay waiting in ``select``) from network-bound (relay
+blocked in writes) after the fact. The records are served at
+``/profile/<uid>`` and removed by the janitor of the logs.
+"""
+
+import array
+import json
+import logging
+import os
+import random
+import resource
+import time
+
+LOG = logging.getLogger(__name__)
+
+WAKE, READ, WRITE = range(3)
+KINDS = ("wake", "read", "write")
+
+RUSAGE_FIELDS = (
+    "ru_utime",
+    "ru_stime",
+    "ru_maxrss",
+    "ru_minflt",
+    "ru_majflt",
+    "ru_inblock",
+    "ru_oublock",
+    "ru_nvcsw",
+    "ru_nivcsw",
+)
+
+
+def rusage_dict(rusage):
+    return {name: getattr(rusage, name) for name in RUSAGE_FIELDS}
+
+
+class FlightRecorder:
+    def __init__(self, size=4096):
+        self.size = size
+        self.start = time.monotonic()
+        self.times = array.array("d", bytes(8 * size))
+        self.durations = array.array("d", bytes(8 * size))
+        self.values = array.array("q", bytes(8 * size))
+        self.kinds = array.array("b", bytes(size))
+        self.count = 0
+        # Totals over all the events, including those overwritten
+        self.waited = 0.0
+        self.writing = 0.0
+        self.reads = 0
+        self.writes = 0
+        self.bytes = 0
+
+    def record(self, kind, value=0, duration=0.0, now=None):
+        i = self.count % self.size
+        self.times[i] = (time.monotonic() if now is None else now) - self.start
+        self.kinds[i] = kind
+        self.values[i] = value
+        self.durations[i] = duration
+        self.count += 1
+
+    def wake(self, ready, waited):
+        self.waited += waited
+        self.record(WAKE, ready, waited)
+
+    def read(self, size):
+        self.reads += 1
+        self.bytes += size
+        self.record(READ, size)
+
+    def write(self, size, duration):
+        self.writes += 1
+        self.writing += duration
+        self.record(WRITE, size, duration)
+
+    def events(self):
+        """Yield the events kept, oldest first."""
+        first = max(0, self.count - self.size)
+        for n in range(first, self.count):
+            i = n % self.size
+            yield dict(
+                time=round(self.times[i], 6),
+                event=KINDS[self.kinds[i]],
+                value=self.values[i],
+                duration=round(self.durations[i], 6),
+            )
+
+    def summary(self):
+        return dict(
+            events=self.count,
+            dropped=max(0, self.count - self.size),
+            waited=self.waited,
+            writing=self.writing,
+            reads=self.reads,
+            writes=self.writes,
+            bytes=self.bytes,
+        )
+
+
+class Profiler:
+    def __init__(self, logstore, threshold=60, sample=1.0, size=4096):
+        self.logstore = logstore
+        self.threshold = threshold
+        self.sample = sample
+        self.size = size
+
+    def path(self, uid):
+        return os.path.splitext(self.logstore.path(uid))[0] + ".profile"
+
+    def recorder(self):
+        """Return a `FlightRecorder` for a new request, or None if not sampled."""
+        if self.sample < 1 and random.random() >= self.sample:
+            return None
+        return FlightRecorder(self.size)
+
+    def finished(self, uid, recorder, elapsed, rusage, trace=None):
+        """Write the record of `uid` if it took more than `threshold` seconds."""
+        if recorder is None or elapsed < self.threshold:
+            return False
+
+        record = dict(
+            uid=uid,
+            elapsed=elapsed,
+            summary=recorder.summary(),
+            mars=rusage_dict(rusage) if rusage is not None else None,
+            relay=rusage_dict(resource.getrusage(resource.RUSAGE_SELF)),
+            trace=trace,
+            events=list(recorder.events()),
+        )
+        try:
+            with open(self.path(uid), "w") as f:
+                json.dump(record, f, default=str)
+        except OSError as e:
+            LOG.error(f"Cannot write the profile of {uid}: {e}")
+            return False
+
+        LOG.warning(f"Slow request {uid} took {elapsed:.1f}s, profile written")
+        return True
+
+    def read(self, uid):
+        """Return the profile of `uid`, or None if there is none."""
+        try:
+            with open(self.path(uid), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
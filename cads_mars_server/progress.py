@@ -0,0 +1,85 @@
+"""Progress of the MARS requests, reported to the clients during retrievals.
+
+A retrieval from tape can run for a long time before the first byte of data.
+Clients asking for it (with the ``X-MARS-PROGRESS`` header, whose value is the
+interval in seconds between reports) get ``PROG`` markers in the stream, whose
+payload is a JSON object with the phase of the request, the number of fields
+retrieved, the number of bytes sent so far and the elapsed time. The phase and
+the fields are inferred from the MARS log, which is tailed as it is written.
+"""
+
+import json
+import os
+import re
+import time
+
+# The last matching pattern seen in the log gives the phase
+PHASES = [
+    (re.compile(rb"Processing request"), "processing"),
+    (re.compile(rb"Calling mars on|Server task is|[Qq]ueued"), "queued"),
+    (re.compile(rb"Request cost"), "scheduled"),
+    (re.compile(rb"Transfer+ing|Reading from"), "transferring"),
+    (re.compile(rb"fields? retrieved"), "retrieved"),
+]
+
+EXPECTED = re.compile(rb"Request cost:\s*([0-9]+) fields?")
+RETRIEVED = re.compile(rb"([0-9]+) fields? retrieved")
+
+MIN_INTERVAL = 1.0
+
+
+class Progress:
+    def __init__(self, logfile):
+        self.logfile = logfile
+        self.offset = 0
+        self.partial = b""
+        self.phase = "starting"
+        self.fields = 0
+        self.expected_fields = None
+        self.start = time.time()
+
+    def _lines(self):
+        try:
+            fd = os.open(self.logfile, os.O_RDONLY)
+        except FileNotFoundError:
+            return []
+        try:
+            data = b""
+            while True:
+                block = os.pread(fd, 64 * 1024, self.offset)
+                if not block:
+                    break
+                self.offset += len(block)
+                data += block
+        finally:
+            os.close(fd)
+
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        return lines
+
+    def update(self):
+        for line in self._lines():
+            for pattern, phase in PHASES:
+                if pattern.search(line):
+                    self.phase = phase
+
+            match = EXPECTED.search(line)
+            if match:
+                self.expected_fields = (self.expected_fields or 0) + int(match.group(1))
+
+            match = RETRIEVED.search(line)
+            if match:
+                self.fields += int(match.group(1))
+
+    def report(self, nbytes):
+        self.update()
+        return json.dumps(
+            dict(
+                phase=self.phase,
+                fields=self.fields,
+                expected_fields=self.expected_fields,
+                bytes=nbytes,
+                elapsed=round(time.time() - self.start, 3),
+            )
+        ).encode()
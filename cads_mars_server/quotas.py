@@ -0,0 +1,222 @@
+"""Per-user concurrency and bandwidth quotas for the server.
+
+The server forks a process per request, so admission is coordinated through a
+state directory shared by all the handlers. Each request waiting for a slot
+has an entry in ``queue/``, each running retrieval one in ``active/``; entries
+left behind by dead processes are purged. The limits are read from a JSON file,
+which is reloaded whenever it changes::
+
+    {
+        "key": "uid",
+        "max_concurrent": 32,
+        "max_wait": 600,
+        "default": {"concurrency": 4, "bandwidth": null, "weight": 1},
+        "keys": {"some-user": {"concurrency": 8, "weight": 2}}
+    }
+
+``key`` is the field of ``environ`` requests are grouped by, ``max_concurrent``
+caps the retrievals of the whole node and ``bandwidth`` is in bytes per second,
+shared by all the retrievals of a key. When a slot frees up, it goes to the
+waiting request whose key has the smallest share of running retrievals,
+relative to its weight, so light users are not stuck behind heavy ones.
+"""
+
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_LIMITS = {"concurrency": 4, "bandwidth": None, "weight": 1}
+
+
+class Limits:
+    def __init__(self, concurrency=None, bandwidth=None, weight=1):
+        self.concurrency = concurrency
+        self.bandwidth = bandwidth
+        self.weight = weight
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(concurrency={self.concurrency},"
+            f" bandwidth={self.bandwidth}, weight={self.weight})"
+        )
+
+
+class Quotas:
+    poll = 0.2
+
+    def __init__(self, path, statedir):
+        self.path = path
+        self.statedir = statedir
+        self.config = {}
+        self._mtime = None
+
+        for name in ("queue", "active"):
+            os.makedirs(os.path.join(statedir, name), exist_ok=True)
+
+        self.reload()
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            with open(self.path) as f:
+                self.config = json.load(f)
+            self._mtime = mtime
+            LOG.info(f"Loaded quotas from {self.path}")
+        except (OSError, ValueError):
+            LOG.exception(f"Cannot load quotas from {self.path}, keeping previous ones")
+
+    def key(self, environ):
+        return str(environ.get(self.config.get("key", "uid")) or "anonymous")
+
+    def limits(self, key):
+        limits = dict(DEFAULT_LIMITS)
+        limits.update(self.config.get("default", {}))
+        limits.update(self.config.get("keys", {}).get(key, {}))
+        return Limits(**limits)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fd = os.open(os.path.join(self.statedir, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _entries(self, kind):
+        """Return the entries of `kind` as a dict name -> key, purging stale ones."""
+        path = os.path.join(self.statedir, kind)
+        entries = {}
+        for name in os.listdir(path):
+            entry = os.path.join(path, name)
+            try:
+                os.kill(int(name.split("-")[1]), 0)
+                with open(entry) as f:
+                    entries[name] = f.read()
+            except (ProcessLookupError, PermissionError):
+                # A process of another user reusing the pid is not a handler
+                LOG.warning(f"Removing stale quota entry {entry}")
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(entry)
+            except (FileNotFoundError, IndexError, ValueError):
+                pass
+        return entries
+
+    def active(self, key):
+        return sum(1 for k in self._entries("active").values() if k == key)
+
+    def _try_admit(self, name):
+        active = self._entries("active")
+        queued = self._entries("queue")
+
+        max_concurrent = self.config.get("max_concurrent")
+        if max_concurrent is not None and len(active) >= max_concurrent:
+            return False
+
+        counts = collections.Counter(active.values())
+        eligible = []
+        for n, key in queued.items():
+            limits = self.limits(key)
+            if limits.concurrency is None or counts[key] < limits.concurrency:
+                eligible.append((counts[key] / limits.weight, n))
+
+        if not eligible or min(eligible)[1] != name:
+            return False
+
+        os.rename(
+            os.path.join(self.statedir, "queue", name),
+            os.path.join(self.statedir, "active", name),
+        )
+        return True
+
+    def admit(self, environ, cancelled):
+        """Wait for a slot for the request of `environ`.
+
+        `cancelled` is called with the number of seconds to wait between two
+        attempts, and returns True if the request should be abandoned. Returns
+        an `Admission`, or None if the request was not admitted.
+        """
+        self.reload()
+        key = self.key(environ)
+        name = f"{int(time.time() * 1e9):020d}-{os.getpid()}"
+        queued = os.path.join(self.statedir, "queue", name)
+
+        with open(queued, "w") as f:
+            f.write(key)
+
+        deadline = time.monotonic() + self.config.get("max_wait", 600)
+        try:
+            while True:
+                with self._locked():
+                    if self._try_admit(name):
+                        LOG.info(f"Admitted request of {key}")
+                        return Admission(self, name, key)
+
+                if time.monotonic() > deadline:
+                    LOG.warning(f"Request of {key} not admitted in time")
+                    return None
+
+                if cancelled(self.poll):
+                    LOG.warning(f"Request of {key} cancelled while queued")
+                    return None
+
+                self.reload()
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(queued)
+
+
+class Admission:
+    """A running retrieval, throttled with a token bucket.
+
+    The bandwidth of the key is shared between its running retrievals, and
+    the share is recomputed every `refresh` seconds.
+    """
+
+    refresh = 1.0
+
+    def __init__(self, quotas, name, key):
+        self.quotas = quotas
+        self.name = name
+        self.key = key
+        self.rate = None
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.next_refresh = self.last
+
+    def _update_rate(self, now):
+        self.quotas.reload()
+        bandwidth = self.quotas.limits(self.key).bandwidth
+        if bandwidth:
+            self.rate = bandwidth / max(1, self.quotas.active(self.key))
+        else:
+            self.rate = None
+        self.next_refresh = now + self.refresh
+
+    def throttle(self, nbytes):
+        now = time.monotonic()
+        if now >= self.next_refresh:
+            self._update_rate(now)
+
+        if self.rate is None:
+            self.last = now
+            return
+
+        # Allow bursts of up to one second worth of data
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+    def release(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(os.path.join(self.quotas.statedir, "active", self.name))
@@ -0,0 +1,107 @@
+"""Replay a trace of requests against a set of servers.
+
+The requests of a trace written by the server (see the `trace` module) are
+sent again with their original timing, scaled by ``speed``, against any set
+of servers, such as a fleet running a stand-in for MARS. A record of the
+outcome of each request is produced, for comparison with the original one.
+"""
+
+import concurrent.futures
+import logging
+import os
+import tempfile
+import time
+
+from .client import RemoteMarsClientCluster
+
+LOG = logging.getLogger(__name__)
+
+
+def _replay_one(record, urls, target_dir, scheduled, origin, cluster_options):
+    environ = dict(record.get("environ") or {})
+    # Let the server pick a new uid, so that replays do not collide
+    environ.pop("request_id", None)
+
+    cluster = RemoteMarsClientCluster(urls=list(urls), **cluster_options)
+
+    fd, target = tempfile.mkstemp(dir=target_dir, suffix=".grib")
+    os.close(fd)
+
+    start = time.monotonic()
+    try:
+        result = cluster.execute(record["request"], environ, target)
+        size = os.path.getsize(target)
+    except Exception as e:
+        LOG.exception("Error replaying request")
+        result = None
+        error = repr(e)
+        size = 0
+    else:
+        error = None if not result.error else repr(result.error)
+    finally:
+        os.unlink(target)
+
+    return dict(
+        uid=record.get("uid"),
+        scheduled=scheduled,
+        lag=start - origin - scheduled,
+        elapsed=time.monotonic() - start,
+        bytes=size,
+        error=error,
+        original_elapsed=record.get("elapsed"),
+        # The size of the result, not of the stream relayed with its framing
+        original_bytes=record.get("payload"),
+        original_status=record.get("status"),
+    )
+
+
+def replay(
+    records,
+    urls,
+    speed=1.0,
+    max_workers=64,
+    target_dir=None,
+    **cluster_options,
+):
+    """Replay `records` against `urls` and yield the outcome of each request.
+
+    `speed` scales the timing of the trace: 2 replays it twice as fast, and 0
+    sends all the requests as fast as `max_workers` allows.
+    """
+    records = sorted(
+        (r for r in records if r.get("request") is not None),
+        key=lambda r: r.get("start", 0),
+    )
+    if not records:
+        return
+
+    cluster_options.setdefault("delay", 1)
+    first = records[0].get("start", 0)
+    origin = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for record in records:
+            scheduled = (record.get("start", 0) - first) / speed if speed else 0
+            wait = origin + scheduled - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            future = executor.submit(
+                _replay_one,
+                record,
+                urls,
+                target_dir,
+                scheduled,
+                origin,
+                cluster_options,
+            )
+            futures.append(future)
+
+            # Report the outcomes as they come
+            for future in [f for f in futures if f.done()]:
+                futures.remove(future)
+                yield future.result()
+
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
@@ -7,21 +7,25 @@ import select
 import signal
 import socket
 import socketserver
+import threading
 import time
 import uuid
 
 import setproctitle
 
+from .chunked import EROR, INDX, PROG, ChunkScanner, frame
+from .gribindex import GribIndexer
+from .logstore import LogCache, LogStore
+from .placement import Placement, Priorities
+from .profiling import Profiler
+from .progress import MIN_INTERVAL, Progress
+from .quotas import Quotas
 from .tools import bytes
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(process)d %(levelname)s %(module)s - %(funcName)s: %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+from .trace import PayloadCounter, TraceLog
 
 LOG = logging.getLogger(__name__)
 ACCEPT_SOCKET = None
+HOSTNAME = socket.gethostname()
 
 
 def validate_uuid(uid):
@@ -66,7 +70,7 @@ def tidy(data):
     return '"{0}"'.format(data)
 
 
-def mars(*, mars_executable, request, uid, logdir, environ):
+def mars(*, mars_executable, request, uid, logfile, environ, priorities=None):
     data_pipe_r, data_pipe_w = os.pipe()
     request_pipe_r, request_pipe_w = os.pipe()
 
@@ -102,19 +106,25 @@ def mars(*, mars_executable, request, uid, logdir, environ):
 
         return data_pipe_r, pid
 
-    # Child process
+    # Child process, SIGTERM was blocked while forking (see `Handler.retrieve`)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+
     os.dup2(request_pipe_r, 0)
     os.close(request_pipe_w)
     os.close(data_pipe_r)
 
     out = os.open(
-        os.path.join(logdir, f"{uid}.log"),
+        logfile,
         os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
         0o644,
     )
     os.dup2(out, 1)
     os.dup2(out, 2)
 
+    if priorities is not None:
+        priorities.apply(environ)
+
     env = dict(os.environ)
 
     for k, v in environ.items():
@@ -140,6 +150,13 @@ class Handler(http.server.BaseHTTPRequestHandler):
     mars_executable = "/usr/local/bin/mars"
     wbufsize = 1024 * 1024
     disable_nagle_algorithm = True
+    quotas = None
+    trace_log = None
+    logstore = None
+    placement = None
+    priorities = None
+    profiler = None
+    mars_pid = None
 
     def do_POST(self):
         signal.signal(signal.SIGALRM, timeout_handler)
@@ -158,14 +175,101 @@ class Handler(http.server.BaseHTTPRequestHandler):
 
         setproctitle.setproctitle(f"cads_mars_server {uid}")
 
-        fd, pid = mars(
-            mars_executable=self.mars_executable,
-            request=request,
+        if self.server.draining:
+            self.send_unavailable(uid)
+            return
+
+        self.trace = dict(
+            start=time.time(),
             uid=uid,
-            logdir=self.logdir,
+            host=HOSTNAME,
+            pid=os.getpid(),
+            client=self.client_address[0],
+            request=request,
             environ=environ,
         )
 
+        try:
+            admission = None
+            if self.quotas is not None:
+                admission = self.quotas.admit(environ, self.client_closed)
+                self.trace["queued"] = time.time() - self.trace["start"]
+                if admission is None:
+                    self.send_too_many_requests(uid)
+                    return
+
+            try:
+                self.retrieve(request, environ, uid, admission)
+            finally:
+                if admission is not None:
+                    admission.release()
+        except Exception as e:
+            self.trace["error"] = repr(e)
+            raise
+        finally:
+            if self.trace_log is not None:
+                self.trace["elapsed"] = time.time() - self.trace["start"]
+                self.trace_log.write(self.trace)
+
+    def client_closed(self, timeout):
+        """Wait up to `timeout` seconds and return True if the client went away."""
+        ready, _, _ = select.select([self.rfile], [], [], timeout)
+        return bool(ready)
+
+    def send_unavailable(self, uid):
+        LOG.warning("Server draining, sending request to the next host")
+        message = json.dumps(dict(retry_next_host=True)).encode()
+        self.send_response(http.HTTPStatus.SERVICE_UNAVAILABLE)
+        self.send_header("X-MARS-UID", uid)
+        self.send_header("X-MARS-RETRY-SAME-HOST", "0")
+        self.send_header("X-MARS-RETRY-NEXT-HOST", "1")
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+    def terminate(self, signum, frame):
+        # MARS killed by SIGTERM makes the client retry on the next host
+        if self.mars_pid is not None:
+            LOG.warning(f"Server stopping, killing mars process {self.mars_pid}")
+            try:
+                os.kill(self.mars_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        else:
+            raise SystemExit(1)
+
+    def send_too_many_requests(self, uid):
+        message = json.dumps(dict(retry_next_host=True)).encode()
+        self.trace.update(status=429, retry_next_host=True)
+        self.send_response(http.HTTPStatus.TOO_MANY_REQUESTS)
+        self.send_header("X-MARS-UID", uid)
+        self.send_header("X-MARS-RETRY-NEXT-HOST", "1")
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+    def retrieve(self, request, environ, uid, admission):
+        if self.placement is not None:
+            # MARS inherits the CPUs of its relay
+            self.placement.apply()
+
+        # A SIGTERM before the pid of MARS is known would leave it running
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        try:
+            fd, pid = mars(
+                mars_executable=self.mars_executable,
+                request=request,
+                uid=uid,
+                logfile=self.logstore.create(uid),
+                environ=environ,
+                priorities=self.priorities,
+            )
+            self.mars_pid = pid
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+
         count = 0
 
         def send_header(
@@ -179,6 +283,13 @@ class Handler(http.server.BaseHTTPRequestHandler):
                 f"Sending header code={code} exited={exited} killed={killed}"
                 f" retry_same_host={retry_same_host} retry_next_host={retry_next_host}"
             )
+            self.trace.update(
+                status=code,
+                exited=exited,
+                killed=killed,
+                retry_same_host=retry_same_host,
+                retry_next_host=retry_next_host,
+            )
             signal.alarm(20)
             self.send_response(code)
             self.send_header("X-MARS-UID", uid)
@@ -199,6 +310,51 @@ class Handler(http.server.BaseHTTPRequestHandler):
             self.end_headers()
             signal.alarm(0)
 
+        recorder = None
+        if self.profiler is not None:
+            recorder = self.profiler.recorder()
+
+        def write(data, flush=False):
+            # socket timeout is not working
+            signal.alarm(20)
+            try:
+                if recorder is not None:
+                    before = time.monotonic()
+                self.wfile.write(data)
+                if flush:
+                    self.wfile.flush()
+                if recorder is not None:
+                    recorder.write(len(data), time.monotonic() - before)
+            except IOError:
+                try:
+                    LOG.error("Error sending data")
+                    LOG.error("Killing mars process %s", pid)
+                    os.kill(pid, signal.SIGKILL)
+                except Exception as e:
+                    LOG.error("Error killing mars process %s", e)
+                    pass
+                raise
+            signal.alarm(0)
+
+        interval = None
+        progress = None
+        indexer = None
+        scanner = None
+        if "X-MARS-PROGRESS" in self.headers:
+            interval = max(float(self.headers["X-MARS-PROGRESS"]), MIN_INTERVAL)
+            progress = Progress(self.logstore.path(uid))
+            scanner = ChunkScanner()
+        if "X-MARS-INDEX" in self.headers:
+            indexer = GribIndexer()
+            scanner = ChunkScanner(on_chunk=indexer.on_chunk)
+        counter = None
+        if self.trace_log is not None:
+            # The trace records the size of the result, as the client sees it
+            counter = PayloadCounter(indexer.on_chunk if indexer else None)
+            scanner = ChunkScanner(on_chunk=counter.on_chunk)
+        last_progress = time.time()
+
+        header_sent = False
         total = 0
         start = time.time()
         data = None
@@ -206,10 +362,13 @@ class Handler(http.server.BaseHTTPRequestHandler):
             os.set_blocking(fd, True)
 
             while True:
-                ready, _, _ = select.select([fd, self.rfile], [], [])
-
-                data = os.read(fd, self.wbufsize)
+                if recorder is not None:
+                    before = time.monotonic()
+                ready, _, _ = select.select([fd, self.rfile], [], [], interval)
+                if recorder is not None:
+                    recorder.wake(len(ready), time.monotonic() - before)
 
+                # Check the client first, MARS may not write anything for a long time
                 if self.rfile in ready:
                     LOG.error("Client closed connection")
                     try:
@@ -220,30 +379,55 @@ class Handler(http.server.BaseHTTPRequestHandler):
                         pass
                     raise IOError("Client closed connection")
 
-                if not data:
-                    break
+                if fd in ready:
+                    data = os.read(fd, self.wbufsize)
+                    if recorder is not None:
+                        recorder.read(len(data))
 
-                if count == 0:
-                    send_header(200)
+                    if not data:
+                        break
 
-                # socket timeout is not working
-                signal.alarm(20)
-                total += len(data)
-                # LOG.info(f"Sending data {len(data)} total {total:_}")
-                try:
-                    self.wfile.write(data)
-                except IOError:
-                    try:
-                        LOG.error("Error sending data")
-                        LOG.error("Killing mars process %s", pid)
-                        os.kill(pid, signal.SIGKILL)
-                    except Exception as e:
-                        LOG.error("Error killing mars process %s", e)
-                        pass
-                    raise
-                signal.alarm(0)
+                    if not header_sent:
+                        send_header(200)
+                        header_sent = True
+
+                    if count == 0:
+                        self.trace["first_byte"] = time.time() - self.trace["start"]
 
-                count += 1
+                    if admission is not None:
+                        admission.throttle(len(data))
+
+                    total += len(data)
+                    # LOG.info(f"Sending data {len(data)} total {total:_}")
+                    if indexer is not None:
+                        # The end of the stream is held back, the index goes before it
+                        write(scanner.relay(data))
+                    else:
+                        write(data)
+                        if scanner is not None:
+                            scanner.feed(data)
+
+                    count += 1
+
+                # Progress can only be inserted between two chunks from MARS
+                if (
+                    progress is not None
+                    and time.time() - last_progress >= interval
+                    and scanner.at_boundary
+                ):
+                    if not header_sent:
+                        send_header(200)
+                        header_sent = True
+                    # The output is buffered, but reports must go out right away
+                    write(frame(PROG, progress.report(total)), flush=True)
+                    last_progress = time.time()
+
+            if indexer is not None and scanner.done:
+                for payload in indexer.payloads():
+                    write(frame(INDX, payload))
+                write(b"0\r\n\r\n")
+                if indexer.complete:
+                    self.trace["indexed"] = len(indexer.messages)
 
         except:
             LOG.exception("Error sending data")
@@ -253,7 +437,13 @@ class Handler(http.server.BaseHTTPRequestHandler):
             signal.alarm(0)  # Just in case
 
             os.close(fd)
-            _, code = os.waitpid(pid, 0)
+            # The resource usage of MARS tells where the time went
+            _, code, rusage = os.wait4(pid, 0)
+            self.mars_pid = None
+            self.trace.update(bytes=total, chunks=count, wait_status=code)
+            if counter is not None:
+                self.trace["payload"] = counter.size
+            self.logstore.finished(uid)
 
             if code != 0:
                 kwargs = {}
@@ -284,25 +474,34 @@ class Handler(http.server.BaseHTTPRequestHandler):
                     kwargs["retry_same_host"] = False
 
                 LOG.error("MARS exited in error %s", kwargs)
-                if count == 0:
+                self.trace.update(kwargs)
+                if not header_sent:
                     LOG.error("Sending error message in header")
                     send_header(status, **kwargs)
                     self.wfile.write(json.dumps(kwargs).encode())
                 else:
                     LOG.error("Sending error message in stream")
-                    self.wfile.write("4\r\nEROR\r\n".encode())
-                    message = json.dumps(kwargs)
-                    self.wfile.write(f"{len(message):x}\r\n{message}\r\n".encode())
+                    self.wfile.write(frame(EROR, json.dumps(kwargs).encode()))
                     self.wfile.write("0\r\n\r\n".encode())
 
+            if recorder is not None:
+                self.trace["profiled"] = self.profiler.finished(
+                    uid,
+                    recorder,
+                    time.time() - self.trace["start"],
+                    rusage,
+                    self.trace,
+                )
+
         elapsed = time.time() - start
         LOG.info(
             f"Transfered {bytes(total)} in {elapsed:.1f}s, {bytes(total / elapsed)}, chunks: {count:,}"
         )
 
     def do_GET(self):
-        """Retrieve the log file for the given UID."""
+        """Retrieve the log file (or the profile) for the given UID."""
         uid = self.path.split("/")[-1]
+        profile = self.path.startswith("/profile/")
 
         LOG.info("GET %s", uid)
 
@@ -311,19 +510,27 @@ class Handler(http.server.BaseHTTPRequestHandler):
             self.end_headers()
             return
 
-        log = os.path.join(self.logdir, f"{uid}.log")
-        if not os.path.exists(log):
+        if profile:
+            log = self.profiler.read(uid) if self.profiler is not None else None
+        else:
+            log = self.logstore.read(uid)
+        if log is None:
             self.send_response(404)
             self.end_headers()
             return
 
-        with open(log, "rb") as f:
-            self.send_response(200)
+        self.send_response(200)
+        if profile:
+            self.send_header("Content-type", "application/json")
+            self.send_header(
+                "Content-Disposition", f"attachment; filename={uid}.profile"
+            )
+        else:
             self.send_header("Content-type", "text/plain")
             self.send_header("Content-Disposition", f"attachment; filename={uid}.log")
-            self.send_header("Content-Length", os.fstat(f.fileno()).st_size)
-            self.end_headers()
-            self.wfile.write(f.read())
+        self.send_header("Content-Length", len(log))
+        self.end_headers()
+        self.wfile.write(log)
 
     def do_DELETE(self):
         """Delete the log file for the given UID."""
@@ -336,49 +543,205 @@ class Handler(http.server.BaseHTTPRequestHandler):
             self.end_headers()
             return
 
-        log = os.path.join(self.logdir, f"{uid}.log")
-        if os.path.exists(log):
-            os.unlink(log)
+        self.logstore.delete(uid)
         self.send_response(204)
         self.end_headers()
 
     def do_HEAD(self):
         # Used as a 'ping'
         LOG.info("ping occuring")
-        self.send_response(204)
+        # A draining server tells the clients to go elsewhere
+        self.send_response(503 if self.server.draining else 204)
         self.end_headers()
 
     def handle(self):
         """Close the accept socket so the main server can restart without a "Address already in use" error."""
         ACCEPT_SOCKET.close()
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, self.terminate)
         return super().handle()
 
 
 class ReuseAddressHTTPServer(http.server.HTTPServer):
+    reuse_port = False
+
     def server_bind(self):
         global ACCEPT_SOCKET
         ACCEPT_SOCKET = self.socket
 
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Lets the next generation of the server listen before this one stops
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         super().server_bind()
 
 
-class ForkingHTTPServer(socketserver.ForkingMixIn, ReuseAddressHTTPServer):
+class StopServing(Exception):
     pass
 
 
-def setup_server(mars_executable, host, port, timeout=30, logdir="."):
+class ForkingHTTPServer(socketserver.ForkingMixIn, ReuseAddressHTTPServer):
+    """The server, which can be drained and stopped without failing requests.
+
+    When draining (on SIGUSR1), new retrievals are answered with a 503 telling
+    the clients to go to the next host, and so are pings. When stopping (on
+    SIGTERM), the server also stops listening and waits for the retrievals in
+    progress, for at most `drain_timeout` seconds, after which their MARS
+    processes are terminated, which also makes the clients go to the next host.
+
+    For a restart without downtime, start the new server with `reuse_port` on
+    the same port, then send SIGTERM to the old one.
+    """
+
+    draining = False
+    stopping = False
+    drain_timeout = None
+
+    def drain(self):
+        if not self.draining:
+            LOG.warning(f"Draining, {len(self.active_children or ())} requests running")
+        self.draining = True
+
+    def stop(self):
+        """Stop serving once the running requests are done, from any thread."""
+        self.drain()
+        self.stopping = True
+
+    def service_actions(self):
+        super().service_actions()
+        if self.stopping:
+            raise StopServing()
+
+    def _signal(self, signum, frame):
+        if signum == signal.SIGTERM:
+            self.stop()
+        else:
+            self.drain()
+
+    def _wait_children(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.active_children:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            self.collect_children()
+            time.sleep(0.1)
+        return True
+
+    def _finish(self):
+        # Let the next generation, if any, take the new connections
+        self.socket.close()
+
+        LOG.warning(f"Waiting for {len(self.active_children or ())} requests")
+        if self._wait_children(self.drain_timeout):
+            return
+
+        for sig, timeout in ((signal.SIGTERM, 30), (signal.SIGKILL, None)):
+            LOG.warning(
+                f"Drain timeout, sending signal {sig} to {self.active_children}"
+            )
+            for pid in list(self.active_children or ()):
+                try:
+                    os.kill(pid, sig)
+                except ProcessLookupError:
+                    pass
+            if self._wait_children(timeout):
+                return
+
+    def serve_forever(self, *args, **kwargs):
+        # The janitor must not keep the listening socket open
+        self.RequestHandlerClass.logstore.start_janitor(after_fork=self.socket.close)
+
+        # Only the main thread can receive signals
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self._signal)
+            signal.signal(signal.SIGTERM, self._signal)
+
+        try:
+            super().serve_forever(*args, **kwargs)
+        except StopServing:
+            self._finish()
+            LOG.warning("Server stopped")
+
+    def server_close(self):
+        self.RequestHandlerClass.logstore.stop_janitor()
+        super().server_close()
+
+
+def setup_server(
+    mars_executable,
+    host,
+    port,
+    timeout=30,
+    logdir=".",
+    quotas=None,
+    trace=None,
+    trace_max_bytes=100 * 1024 * 1024,
+    trace_backups=5,
+    log_max_age=None,
+    log_max_size=None,
+    log_cache_slots=0,
+    log_cache_slot_size=64 * 1024,
+    reuse_port=False,
+    drain_timeout=None,
+    placement="none",
+    placement_size=2,
+    priority_key="class",
+    priorities=(),
+    profile_threshold=None,
+    profile_sample=1.0,
+    profile_size=4096,
+):
     _ = {
         "mars_executable": mars_executable,
         "timeout": timeout,
         "logdir": logdir,
+        "quotas": None,
+        "trace_log": None,
+        "logstore": None,
+        "reuse_port": reuse_port,
+        "drain_timeout": drain_timeout,
+        "placement": None,
+        "priorities": None,
+        "profiler": None,
     }
 
+    if placement != "none":
+        _["placement"] = Placement(placement, placement_size)
+
+    if priorities:
+        _["priorities"] = Priorities.from_options(priority_key, priorities)
+
+    cache = None
+    if log_cache_slots:
+        cache = LogCache(log_cache_slots, log_cache_slot_size)
+    _["logstore"] = LogStore(logdir, log_max_age, log_max_size, cache)
+
+    if profile_threshold is not None:
+        _["profiler"] = Profiler(
+            _["logstore"], profile_threshold, profile_sample, profile_size
+        )
+
+    if quotas is not None:
+        _["quotas"] = Quotas(quotas, os.path.join(logdir, ".quotas"))
+
+    if trace is not None:
+        _["trace_log"] = TraceLog(trace, trace_max_bytes, trace_backups)
+
     class ThisHandler(Handler):
         timeout = _["timeout"]
         mars_executable = _["mars_executable"]
         logdir = _["logdir"]
-
-    server = ForkingHTTPServer((host, port), ThisHandler)
+        quotas = _["quotas"]
+        trace_log = _["trace_log"]
+        logstore = _["logstore"]
+        placement = _["placement"]
+        priorities = _["priorities"]
+        profiler = _["profiler"]
+
+    class ThisServer(ForkingHTTPServer):
+        reuse_port = _["reuse_port"]
+        drain_timeout = _["drain_timeout"]
+
+    server = ThisServer((host, port), ThisHandler)
     return server
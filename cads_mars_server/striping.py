@@ -0,0 +1,196 @@
+"""Striped retrievals, to spread a single large request over several servers.
+
+When striping is enabled, a request is split into ``stripes`` requests along
+its outermost axis with several values (see `AXES`), each retrieving
+consecutive values, and the stripes are retrieved concurrently, each from its
+own host, failing over to the other ones. The stripes are put together in the
+order of the values, so the order of the fields does not depend on which
+stripe finishes first.
+
+The size of a stripe is only known once it has been retrieved, so its place
+in the target cannot be computed in advance. The first stripe is written to
+the target, the other ones to scratch files next to it, each with its own
+writer so that rewinds only affect their stripe. As soon as all the stripes
+before it are complete, a stripe is copied after them in the kernel with
+`os.copy_file_range`, while the next ones are still being retrieved. When a
+stripe fails, the other ones are cancelled, as their result would be lost.
+"""
+
+import concurrent.futures
+import contextlib
+import logging
+import os
+import shutil
+import threading
+
+from .client import Result
+from .gribindex import sidecar, write_sidecar
+
+LOG = logging.getLogger(__name__)
+
+# Axes a request can be split along, outermost first
+AXES = ("date", "time", "step", "number", "levelist", "param")
+
+
+def _values(value):
+    if isinstance(value, (list, tuple)):
+        values = [str(v) for v in value]
+    else:
+        values = str(value).split("/")
+    # Ranges would have to be expanded, which needs to know the calendar
+    if any(v.strip().lower() in ("to", "by") for v in values):
+        return []
+    return values
+
+
+def split(request, stripes):
+    """Return `request` split into at most `stripes` requests."""
+    keys = {k.lower(): k for k in request}
+    for axis in AXES:
+        if axis not in keys:
+            continue
+        key = keys[axis]
+        values = _values(request[key])
+        if len(values) < 2:
+            continue
+
+        n = min(stripes, len(values))
+        size, extra = divmod(len(values), n)
+        result = []
+        start = 0
+        for i in range(n):
+            end = start + size + (i < extra)
+            result.append(dict(request, **{key: "/".join(values[start:end])}))
+            start = end
+        return result
+
+    return [request]
+
+
+def _copy(src, dst, offset):
+    """Append the file `src` to `dst` at `offset`, return the number of bytes."""
+    with open(src, "rb") as s, open(dst, "r+b") as d:
+        d.truncate(offset)
+        size = os.fstat(s.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                n = os.copy_file_range(
+                    s.fileno(), d.fileno(), size - copied, copied, offset + copied
+                )
+                if n == 0:
+                    break
+                copied += n
+        except (OSError, AttributeError):
+            # E.g. not supported by the file system, or before Python 3.8
+            s.seek(copied)
+            d.seek(offset + copied)
+            shutil.copyfileobj(s, d, 1024 * 1024)
+            copied = size
+    return copied
+
+
+class Stripe:
+    """The retrieval of a stripe, which can be cancelled from another thread."""
+
+    def __init__(self, cluster, urls, request, environ, target, open_mode, position):
+        self.cluster = cluster
+        self.args = (urls, request, environ, target, open_mode, position)
+        self.client = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def _attach(self, client):
+        with self.lock:
+            self.client = client
+            if self.cancelled:
+                client.cancel()
+
+    def run(self):
+        try:
+            return self.cluster.failover(*self.args, on_client=self._attach)
+        except Exception as e:
+            LOG.exception(f"Error retrieving stripe {self.args[3]}")
+            return Result(error=e)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.client is not None:
+                self.client.cancel()
+
+
+def execute(cluster, urls, stripes, environ, target, open_mode, position):
+    """Retrieve the `stripes` of a request concurrently, into `target`."""
+    scratches = [target] + [f"{target}.stripe-{i}" for i in range(1, len(stripes))]
+    indexed = cluster.index
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(stripes), thread_name_prefix="cads-mars-stripe"
+    )
+    try:
+        running = []
+        for i, (request, scratch) in enumerate(zip(stripes, scratches)):
+            # Each stripe starts on its own host
+            rotated = urls[i % len(urls) :] + urls[: i % len(urls)]
+            if i == 0:
+                mode, start = open_mode, position
+            else:
+                mode, start = "wb", 0
+            running.append(
+                Stripe(cluster, rotated, request, environ, scratch, mode, start)
+            )
+
+        failures = []
+
+        def check(future):
+            if future.cancelled() or not future.result().error:
+                return
+            failures.append(future.result())
+            # The other stripes would be thrown away, whichever fails first
+            for stripe in running:
+                stripe.cancel()
+
+        futures = []
+        for stripe in running:
+            futures.append(executor.submit(stripe.run))
+            futures[-1].add_done_callback(check)
+
+        messages = []
+        offset = None
+        for i, future in enumerate(futures):
+            reply = future.result()
+            messages.append(f"{reply.message}")
+            if reply.error:
+                LOG.error(f"Stripe {i} of {len(stripes)} failed")
+                # Rather than the error of a stripe it cancelled
+                reply = failures[0] if failures else reply
+                break
+
+            if i == 0:
+                offset = os.path.getsize(target)
+                indexed = indexed and os.path.exists(sidecar(target))
+                continue
+
+            copied = _copy(scratches[i], target, offset)
+            if indexed and os.path.exists(sidecar(scratches[i])):
+                with open(sidecar(scratches[i]), "rb") as f:
+                    write_sidecar(sidecar(target), [f.read()], offset, append=True)
+            elif indexed:
+                # A partial index would be misleading
+                indexed = False
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(sidecar(target))
+            LOG.info(f"Stripe {i} of {len(stripes)} copied at {offset:,}")
+            offset += copied
+
+        reply.message = "\n".join(messages)
+        return reply
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for scratch in scratches[1:]:
+            for path in (scratch, sidecar(scratch)):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
@@ -1,3 +1,9 @@
+import contextlib
+import os
+import shutil
+import threading
+
+
 def bytes(n):
     if n < 0:
         sign = "-"
@@ -11,3 +17,30 @@ def bytes(n):
         n /= 1024.0
         i += 1
     return "%s%g%s" % (sign, int(n * 10 + 0.5) / 10.0, u[i])
+
+
+def unshare(path, truncate=False):
+    """Make sure that writing to `path` leaves the files it is linked to alone.
+
+    Results delivered from a cache may be hard links to its entries. With
+    `truncate`, `path` is removed, to be created again; otherwise a hard link
+    is replaced by a copy of its content.
+    """
+    if truncate:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        return
+
+    try:
+        if os.stat(path).st_nlink == 1:
+            return
+    except FileNotFoundError:
+        return
+
+    scratch = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        shutil.copyfile(path, scratch)
+        os.replace(scratch, path)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(scratch)
@@ -0,0 +1,117 @@
+"""Structured trace of the requests served, as JSON lines.
+
+Each handler collects the record of its request in memory and appends it
+with a single `os.write` once the transfer is over, so the relay loop never
+waits on the trace. With ``O_APPEND``, records written concurrently by the
+forked handlers do not interleave. Rotation is size based and serialised
+between the handlers by a lock file. The records can be replayed against a
+set of servers with the ``replay`` command.
+"""
+
+import fcntl
+import json
+import logging
+import os
+
+from .chunked import PAYLOAD_MARKERS, RWND
+
+LOG = logging.getLogger(__name__)
+
+
+class TraceLog:
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def _rotate(self, size):
+        fd = os.open(f"{self.path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # Another handler may have rotated the file in the meantime
+            try:
+                if os.stat(self.path).st_size + size <= self.max_bytes:
+                    return
+            except FileNotFoundError:
+                return
+
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+
+            if self.backups:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.unlink(self.path)
+        finally:
+            os.close(fd)
+
+    def write(self, record):
+        try:
+            line = (json.dumps(record, default=str) + "\n").encode()
+
+            if self.max_bytes:
+                try:
+                    if os.stat(self.path).st_size + len(line) > self.max_bytes:
+                        self._rotate(len(line))
+                except FileNotFoundError:
+                    pass
+
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except Exception:
+            # The trace must never break a request
+            LOG.exception(f"Cannot write trace to {self.path}")
+
+
+class PayloadCounter:
+    """Count the bytes of data of a MARS stream, to be passed to `ChunkScanner`.
+
+    Rewinds reset the count, so that it is the size of the result written by
+    the client. Chunks are passed on to `forward`, if any.
+    """
+
+    def __init__(self, forward=None):
+        self.forward = forward
+        self.size = 0
+        self.left = 0
+        self.marker = b""
+        self.payload = False
+        self.after_marker = False
+
+    def on_chunk(self, data, size):
+        if self.forward is not None:
+            self.forward(data, size)
+
+        if not self.left:
+            # A new chunk, maybe the payload of the marker before it
+            self.left = size
+            self.marker = b""
+            self.payload = self.after_marker
+            self.after_marker = False
+        self.left -= len(data)
+
+        if self.payload:
+            return
+
+        # Four bytes chunks are the control markers
+        if size == 4:
+            self.marker += bytes(data)
+            if not self.left:
+                if self.marker == RWND:
+                    self.size = 0
+                self.after_marker = self.marker in PAYLOAD_MARKERS
+            return
+
+        self.size += len(data)
+
+
+def read(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
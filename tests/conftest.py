@@ -0,0 +1,54 @@
+import os
+import sys
+import threading
+
+import pytest
+
+from cads_mars_server import server
+
+FAKE_MARS = os.path.join(os.path.dirname(__file__), "fake_mars.py")
+
+
+def write_mars_executable(path, **environ):
+    with open(FAKE_MARS) as f:
+        source = f.read()
+    lines = [f"#!{sys.executable}", "import os"]
+    lines += [f"os.environ[{k!r}] = {str(v)!r}" for k, v in environ.items()]
+    path.write_text("\n".join(lines) + "\n" + source)
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def mars_executable(tmp_path):
+    return write_mars_executable(tmp_path / "mars")
+
+
+@pytest.fixture
+def mars_servers(tmp_path):
+    """Start servers running the fake MARS, with the given environment and options."""
+    servers = []
+
+    def start(mars_environ=None, **options):
+        directory = tmp_path / f"server-{len(servers)}"
+        logdir = directory / "logs"
+        logdir.mkdir(parents=True)
+        mars = write_mars_executable(directory / "mars", **(mars_environ or {}))
+
+        httpd = server.setup_server(mars, "127.0.0.1", 0, logdir=str(logdir), **options)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    # The servers started, in order
+    start.servers = servers
+    yield start
+
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture
+def mars_server(mars_servers):
+    return mars_servers()
@@ -0,0 +1,76 @@
+"""A stand-in for the MARS client, writing a synthetic result to its target.
+
+The request keys understood are ``size`` (bytes to write), ``chunk`` (chunk
+size), ``delay`` (seconds to wait before writing, defaults to the value of
+``FAKE_MARS_DELAY``), ``exit`` (exit code, defaults to the value of
+``FAKE_MARS_EXIT``) and ``grib`` (when set, each
+chunk is a GRIB 2 message, whose level is its number). With ``grib``, a
+``levelist`` gives one message per level instead.
+"""
+
+import os
+import re
+import signal
+import sys
+import time
+
+
+def grib(length, level):
+    section1 = (21).to_bytes(4, "big") + bytes([1]) + bytes(7)
+    section1 += (2024).to_bytes(2, "big") + bytes([1, 2, 12, 0, 0, 0, 0])
+    section4 = bytearray(34)
+    section4[:5] = (34).to_bytes(4, "big") + bytes([4])
+    section4[9:11] = bytes([0, 4])
+    section4[22] = 100
+    section4[24:28] = level.to_bytes(4, "big")
+    section0 = b"GRIB" + bytes([0, 0, 0, 2]) + length.to_bytes(8, "big")
+    head = section0 + section1 + bytes(section4)
+    return head + bytes(length - len(head) - 4) + b"7777"
+
+
+def main():
+    text = sys.stdin.read()
+    print(text)
+
+    fd = int(re.search(r"TARGET='&(\d+)'", text).group(1))
+    params = dict(re.findall(r"^(\w+)=(.*),$", text, re.M))
+
+    size = int(params.get("size", 1024))
+    chunk = int(params.get("chunk", 64 * 1024))
+    exitcode = int(params.get("exit", os.environ.get("FAKE_MARS_EXIT", 0)))
+
+    levels = None
+    if "grib" in params and "levelist" in params:
+        levels = [int(v) for v in params["levelist"].split("/")]
+        size = chunk * len(levels)
+
+    fields = -(-size // chunk)
+    print(f"Running on CPUs {sorted(os.sched_getaffinity(0))}, nice {os.nice(0)}")
+    print(f"Blocked signals {sorted(signal.pthread_sigmask(signal.SIG_BLOCK, []))}")
+    print("Calling mars on 'fake', local port is 0", flush=True)
+    print(f"Request cost: {fields} fields, {size} bytes online", flush=True)
+
+    time.sleep(float(params.get("delay", os.environ.get("FAKE_MARS_DELAY", 0))))
+
+    def send(data):
+        os.write(fd, b"%x\r\n%s\r\n" % (len(data), data))
+
+    block = bytes(i % 251 for i in range(chunk))
+    number = 0
+    while size > 0:
+        if "grib" in params:
+            block = grib(chunk, levels[number] if levels else number)
+            number += 1
+        send(block[: min(size, chunk)])
+        size -= chunk
+
+    if exitcode:
+        sys.exit(exitcode)
+
+    print(f"{fields} fields retrieved from 'fake'", flush=True)
+    send(b"ENDR")
+    os.write(fd, b"0\r\n\r\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import json
+import subprocess
+import sys
+
+HEAVY = {"requests", "urllib3", "setproctitle", "cads_mars_server.server"}
+
+PROBE = """
+import json, logging, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(
+    elapsed=elapsed,
+    modules=sorted(sys.modules),
+    handlers=len(logging.getLogger().handlers),
+)))
+"""
+
+
+def probe(module):
+    captured = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module)],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    result = json.loads(captured.stdout)
+    print(f"Imported {module} in {result['elapsed']:.3f}s")
+    return result
+
+
+def test_client_import_is_lightweight():
+    result = probe("cads_mars_server.client")
+    assert not HEAVY & set(result["modules"])
+    assert result["handlers"] == 0
+
+
+def test_cli_import_is_lightweight():
+    result = probe("cads_mars_server.__main__")
+    assert not HEAVY & set(result["modules"])
+    assert "cads_mars_server.client" not in result["modules"]
+    # Only catches gross regressions, what is imported is checked above
+    assert result["elapsed"] < 5.0
+
+
+def test_server_import_has_no_side_effects():
+    result = probe("cads_mars_server.server")
+    assert result["handlers"] == 0
+
+
+def test_transport_is_created_on_first_use():
+    from cads_mars_server import client
+
+    assert client.session() is client.session()
@@ -0,0 +1,70 @@
+import io
+import os
+
+import pytest
+
+from cads_mars_server import chunked
+
+
+def frame(*chunks):
+    return b"".join(b"%x\r\n%s\r\n" % (len(c), c) for c in chunks) + b"0\r\n\r\n"
+
+
+def decode(stream, bufsize=16):
+    reader = chunked.ChunkedReader(io.BytesIO(stream).readinto, bufsize)
+    result = []
+    for marker, data in reader:
+        result.append((marker, bytes(data) if marker is None else data))
+    return result
+
+
+def test_chunked_reader_data_and_markers():
+    stream = frame(b"hello", b"RWND", b"a" * 40, b"ENDR")
+    result = decode(stream)
+
+    assert b"".join(d for m, d in result if m is None) == b"hello" + b"a" * 40
+    assert [m for m, _ in result if m is not None] == [chunked.RWND, chunked.ENDR]
+
+
+def test_chunked_reader_error_payload():
+    result = decode(frame(b"data!", b"EROR", b'{"exited": 1}'))
+    assert result[-1] == (chunked.EROR, b'{"exited": 1}')
+
+
+def test_chunked_reader_errors():
+    with pytest.raises(ValueError):
+        decode(frame(b"XXXX"))
+
+    with pytest.raises(chunked.ProtocolError):
+        decode(frame(b"hello world")[:10])
+
+    with pytest.raises(chunked.ProtocolError):
+        decode(b"zz\r\n")
+
+
+def test_positional_writer(tmp_path):
+    target = tmp_path / "target"
+    target.write_bytes(b"previous")
+
+    fd = os.open(target, os.O_WRONLY)
+    try:
+        writer = chunked.PositionalWriter(fd, position=8, bufsize=4)
+        writer.write(b"ab")
+        writer.write(b"cdefgh")
+        writer.rewind()
+        writer.write(b"xyz")
+        writer.flush()
+        assert writer.written == 3
+    finally:
+        os.close(fd)
+
+    assert target.read_bytes() == b"previousxyz"
+
+
+def test_reframer_keeps_markers():
+    chunks = [b"hello", b"RWND", b"a" * 40, b"", b"ENDR"]
+    reader = chunked.ChunkedReader(chunked.Reframer(chunks).readinto, 16)
+    result = [(m, bytes(d) if m is None else d) for m, d in reader]
+
+    assert b"".join(d for m, d in result if m is None) == b"hello" + b"a" * 40
+    assert [m for m, _ in result if m is not None] == [chunked.RWND, chunked.ENDR]
@@ -0,0 +1,47 @@
+from cads_mars_server import client
+
+
+def test_retrieve(mars_server, tmp_path):
+    target = tmp_path / "data.grib"
+    cluster = client.RemoteMarsClientCluster(urls=[mars_server], delay=0)
+
+    result = cluster.execute({"size": 1_000_000, "chunk": 3000}, {}, str(target))
+
+    assert not result.error
+    assert target.stat().st_size == 1_000_000
+    assert "RETRIEVE" in result.message
+
+
+def test_retrieve_error(mars_server, tmp_path):
+    target = tmp_path / "data.grib"
+    cluster = client.RemoteMarsClientCluster(urls=[mars_server], delay=0)
+
+    result = cluster.execute({"size": 10, "exit": 3}, {}, str(target))
+
+    assert isinstance(result.error, client.ClientError)
+    assert result.error.message == {"exited": 3}
+
+
+class OpaqueRaw:
+    """A urllib3 response without the private attributes of http.client."""
+
+    def __init__(self, raw):
+        self.read_chunked = raw.read_chunked
+        self.close = raw.close
+
+
+def test_retrieve_without_raw_stream(mars_server, tmp_path, monkeypatch):
+    transfer = client.RemoteMarsClientSession._transfer
+
+    def opaque_transfer(self, r):
+        r.raw = OpaqueRaw(r.raw)
+        return transfer(self, r)
+
+    monkeypatch.setattr(client.RemoteMarsClientSession, "_transfer", opaque_transfer)
+    target = tmp_path / "data.grib"
+    cluster = client.RemoteMarsClientCluster(urls=[mars_server], delay=0)
+
+    result = cluster.execute({"size": 100_000, "chunk": 3000}, {}, str(target))
+
+    assert not result.error
+    assert target.stat().st_size == 100_000
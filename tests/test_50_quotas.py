@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+import time
+
+from cads_mars_server import client, quotas, server
+
+
+def never_cancelled(timeout):
+    time.sleep(timeout)
+    return False
+
+
+def make_quotas(tmp_path, **config):
+    path = tmp_path / "quotas.json"
+    path.write_text(json.dumps(config))
+    result = quotas.Quotas(str(path), str(tmp_path / "state"))
+    result.poll = 0.01
+    return result
+
+
+def test_concurrency_per_key(tmp_path):
+    q = make_quotas(tmp_path, max_wait=0.1, default={"concurrency": 1})
+
+    first = q.admit({"uid": "alice"}, never_cancelled)
+    assert first is not None
+    assert q.admit({"uid": "alice"}, never_cancelled) is None
+
+    other = q.admit({"uid": "bob"}, never_cancelled)
+    assert other is not None
+
+    first.release()
+    assert q.admit({"uid": "alice"}, never_cancelled) is not None
+
+
+def test_fair_share(tmp_path):
+    q = make_quotas(tmp_path, max_concurrent=2, default={"concurrency": 10})
+
+    heavy = q.admit({"uid": "heavy"}, never_cancelled)
+    assert heavy is not None
+
+    # A request of "heavy" queued first loses against the lighter "light"
+    queue = tmp_path / "state" / "queue"
+    (queue / f"{0:020d}-{os.getpid()}").write_text("heavy")
+    (queue / f"{1:020d}-{os.getpid()}").write_text("light")
+    assert not q._try_admit(f"{0:020d}-{os.getpid()}")
+    assert q._try_admit(f"{1:020d}-{os.getpid()}")
+
+
+def test_entries_of_other_users_are_stale(tmp_path, monkeypatch):
+    q = make_quotas(tmp_path, default={"concurrency": 1})
+    active = tmp_path / "state" / "active"
+    (active / f"{0:020d}-12345").write_text("alice")
+
+    def kill(pid, signal):
+        raise PermissionError(1, "Operation not permitted")
+
+    monkeypatch.setattr(os, "kill", kill)
+    assert q.active("alice") == 0
+    assert not list(active.iterdir())
+
+
+def test_reload_and_bandwidth(tmp_path):
+    q = make_quotas(tmp_path)
+    assert q.limits("alice").bandwidth is None
+
+    time.sleep(0.01)
+    (tmp_path / "quotas.json").write_text(
+        json.dumps({"keys": {"alice": {"bandwidth": 10_000_000}}})
+    )
+    q.reload()
+    assert q.limits("alice").bandwidth == 10_000_000
+
+    admission = q.admit({"uid": "alice"}, never_cancelled)
+    start = time.monotonic()
+    for _ in range(30):
+        admission.throttle(100_000)
+    assert time.monotonic() - start > 0.15
+
+
+def test_server_rejects_when_full(tmp_path, mars_executable):
+    (tmp_path / "quotas.json").write_text(
+        json.dumps({"max_concurrent": 0, "max_wait": 0})
+    )
+    httpd = server.setup_server(
+        mars_executable,
+        "127.0.0.1",
+        0,
+        logdir=str(tmp_path),
+        quotas=str(tmp_path / "quotas.json"),
+    )
+
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        session = client.RemoteMarsClientSession(
+            url=f"http://127.0.0.1:{httpd.server_address[1]}",
+            request={"size": 10},
+            environ={},
+            target=str(tmp_path / "data"),
+        )
+        result = session.execute()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert result.retry_next_host
+    assert result.error is not None
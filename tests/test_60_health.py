@@ -0,0 +1,89 @@
+import socket
+
+from cads_mars_server import client, health
+
+
+def test_circuit_breaker():
+    h = health.HostHealth(threshold=2, cooldown=0.05, ttl=60)
+    url = "http://host-a"
+
+    assert h.state(url) is None
+    assert not h.is_healthy(url)
+
+    h.success(url)
+    assert h.is_healthy(url)
+
+    h.failure(url)
+    assert h.state(url) == health.CLOSED
+    assert not h.is_healthy(url)
+
+    h.failure(url)
+    assert h.state(url) == health.OPEN
+    assert not h.acquire(url)
+    assert h.order([url, "http://host-b"]) == ["http://host-b", url]
+
+    h.hosts[url]["until"] = 0
+    assert h.state(url) == health.HALF_OPEN
+    assert h.acquire(url)
+    # Only one trial at a time
+    assert not h.acquire(url)
+
+    h.success(url)
+    assert h.state(url) == health.CLOSED
+
+
+def test_shared_health_file(tmp_path):
+    path = str(tmp_path / "health.json")
+    first = health.HostHealth(path=path)
+    second = health.HostHealth(path=path)
+
+    first.failure("http://host-a")
+    assert second.state("http://host-a") == health.OPEN
+
+
+def test_backoff():
+    for attempt in range(5):
+        value = health.backoff(1, attempt, maximum=8)
+        assert min(2**attempt, 8) / 2 <= value <= min(2**attempt, 8)
+
+
+def test_cluster_avoids_dead_host(mars_server, tmp_path):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        dead = f"http://127.0.0.1:{s.getsockname()[1]}"
+
+    h = health.HostHealth()
+    cluster = client.RemoteMarsClientCluster(
+        urls=[dead, mars_server], delay=0, health=h
+    )
+
+    for _ in range(3):
+        result = cluster.execute({"size": 10}, {}, str(tmp_path / "data"))
+        assert not result.error
+
+    assert h.state(mars_server) == health.CLOSED
+    assert h.state(dead) in (None, health.OPEN)
+
+
+def test_trial_request_taken(mars_server, tmp_path):
+    recovering = "http://recovering"
+    h = health.HostHealth(threshold=1)
+    h.success(mars_server)
+    h.failure(recovering)
+    h.hosts[recovering]["until"] = 0
+    # Another request is on trial on the recovering host
+    assert h.acquire(recovering)
+
+    cluster = client.RemoteMarsClientCluster(
+        urls=[recovering, mars_server], delay=0, health=h
+    )
+    assert list(cluster.usable([recovering, mars_server])) == [
+        mars_server,
+        recovering,
+    ]
+
+    tried = []
+    clients = cluster.client
+    cluster.client = lambda url, *args: tried.append(url) or clients(url, *args)
+    assert not cluster.execute({"size": 10}, {}, str(tmp_path / "data")).error
+    assert tried == [mars_server]
@@ -0,0 +1,41 @@
+import time
+
+from cads_mars_server import client, health, hedging
+
+
+def test_hedge_budget():
+    budget = hedging.HedgeBudget(tokens=1, max_tokens=2)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    for _ in range(4):
+        budget.deposit(0.25)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+def test_hedged_request(mars_servers, tmp_path, monkeypatch):
+    monkeypatch.setattr(hedging, "BUDGET", hedging.HedgeBudget())
+
+    slow = mars_servers(mars_environ={"FAKE_MARS_DELAY": 30})
+    fast = mars_servers()
+
+    h = health.HostHealth()
+    h.success(slow)
+    h.success(fast)
+    monkeypatch.setattr(h, "order", lambda urls: list(urls))
+
+    cluster = client.RemoteMarsClientCluster(
+        urls=[slow, fast], delay=0, health=h, hedge_after=0.5
+    )
+
+    target = tmp_path / "data.grib"
+    start = time.time()
+    result = cluster.execute({"size": 100_000}, {}, str(target))
+
+    assert not result.error
+    assert time.time() - start < 10
+    assert target.stat().st_size == 100_000
+    assert not (tmp_path / "data.grib.hedge").exists()
+    # Cancelling the stalled request is not a failure of its host
+    assert h.state(slow) == health.CLOSED
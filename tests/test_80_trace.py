@@ -0,0 +1,58 @@
+import json
+
+from cads_mars_server import chunked, client, replay, trace
+
+
+def test_trace_rotation(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    log = trace.TraceLog(str(path), max_bytes=100, backups=2)
+
+    for i in range(10):
+        log.write(dict(i=i, padding="x" * 20))
+
+    assert len(list(trace.read(path))) <= 3
+    assert (tmp_path / "trace.jsonl.1").exists()
+    assert (tmp_path / "trace.jsonl.2").exists()
+    assert not (tmp_path / "trace.jsonl.3").exists()
+    assert json.loads((tmp_path / "trace.jsonl").read_text().splitlines()[-1])["i"] == 9
+
+
+def test_trace_and_replay(mars_servers, tmp_path):
+    path = tmp_path / "trace.jsonl"
+    url = mars_servers(trace=str(path))
+
+    cluster = client.RemoteMarsClientCluster(urls=[url], delay=0)
+    for size in (1000, 2000):
+        result = cluster.execute(
+            {"size": size}, {"uid": "alice"}, str(tmp_path / "data")
+        )
+        assert not result.error
+    cluster.execute({"size": 10, "exit": 2}, {}, str(tmp_path / "data"))
+
+    records = list(trace.read(path))
+    # Bytes relayed, chunked framing included
+    assert 1000 < records[0]["bytes"] < records[1]["bytes"]
+    assert [r["payload"] for r in records] == [1000, 2000, 10]
+    assert [r["status"] for r in records] == [200, 200, 200]
+    assert records[0]["environ"] == {"uid": "alice"}
+    assert records[2]["exited"] == 2
+    assert all(r["elapsed"] >= 0 for r in records)
+
+    outcomes = list(
+        replay.replay(records, [url], speed=0, target_dir=str(tmp_path), delay=0)
+    )
+    assert sorted(o["bytes"] for o in outcomes) == [0, 1000, 2000]
+    assert all(o["bytes"] == o["original_bytes"] for o in outcomes if not o["error"])
+    assert sum(o["error"] is not None for o in outcomes) == 1
+
+
+def test_payload_counter():
+    counter = trace.PayloadCounter()
+    scanner = chunked.ChunkScanner(on_chunk=counter.on_chunk)
+    stream = b"".join(
+        b"%x\r\n%s\r\n" % (len(c), c)
+        for c in (b"a" * 10, b"RWND", b"b" * 7, b"EROR", b"{}", b"c" * 3)
+    )
+    for i in range(0, len(stream), 3):
+        scanner.feed(stream[i : i + 3])
+    assert counter.size == 10
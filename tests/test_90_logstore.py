@@ -0,0 +1,86 @@
+import os
+import time
+import uuid
+
+from cads_mars_server import client, logstore
+
+
+def test_sharded_paths(tmp_path):
+    store = logstore.LogStore(str(tmp_path))
+    uid = str(uuid.uuid4())
+    # Subdirectories are only created when needed
+    assert os.listdir(tmp_path) == []
+
+    path = store.create(uid)
+    assert path == store.path(uid)
+    assert os.path.dirname(os.path.dirname(path)) == str(tmp_path)
+    assert logstore.SHARD.match(os.path.basename(os.path.dirname(path)))
+
+    assert store.read(uid) is None
+    with open(path, "w") as f:
+        f.write("log")
+    assert store.read(uid) == b"log"
+
+    store.delete(uid)
+    assert not os.path.exists(path)
+
+
+def test_janitor_limits(tmp_path):
+    store = logstore.LogStore(str(tmp_path), max_age=3600, max_size=25)
+    now = time.time()
+
+    paths = []
+    for age in (7200, 30, 20, 10):
+        path = store.create(str(uuid.uuid4()))
+        with open(path, "w") as f:
+            f.write("x" * 10)
+        os.utime(path, (now - age, now - age))
+        paths.append(path)
+
+    # A log left over from before sharding
+    legacy = tmp_path / f"{uuid.uuid4()}.log"
+    legacy.write_text("x")
+    os.utime(legacy, (now - 7200, now - 7200))
+    # Other files in the log directory are not the server's
+    other = tmp_path / "server.log"
+    other.write_text("x")
+    os.utime(other, (now - 7200, now - 7200))
+
+    assert store.clean(now) == 3
+    assert [os.path.exists(p) for p in paths] == [False, False, True, True]
+    assert not legacy.exists()
+    assert other.exists()
+
+
+def test_log_cache_shared_across_fork():
+    cache = logstore.LogCache(slots=2, slot_size=16)
+    uids = [str(uuid.uuid4()) for _ in range(3)]
+
+    pid = os.fork()
+    if pid == 0:
+        cache.put(uids[0], b"first")
+        cache.put(uids[1], b"second")
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert cache.get(uids[0]) == b"first"
+    assert not cache.put(uids[2], b"x" * 17)
+
+    cache.put(uids[2], b"third")
+    assert cache.get(uids[0]) is None
+    assert cache.get(uids[2]) == b"third"
+
+    cache.discard(uids[1])
+    assert cache.get(uids[1]) is None
+
+
+def test_server_log_cache(mars_servers, tmp_path):
+    url = mars_servers(log_cache_slots=4)
+    cluster = client.RemoteMarsClientCluster(urls=[url], delay=0)
+
+    result = cluster.execute({"size": 10}, {}, str(tmp_path / "data"))
+    assert not result.error
+    assert "RETRIEVE" in result.message
+
+    logdir = tmp_path / "server-0" / "logs"
+    assert not [p for p in logdir.glob("*/*.log")]
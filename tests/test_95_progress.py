@@ -0,0 +1,80 @@
+from cads_mars_server import chunked, client, health, progress
+
+
+def test_chunk_scanner():
+    chunks = []
+    scanner = chunked.ChunkScanner(
+        lambda data, size: chunks.append((bytes(data), size))
+    )
+    stream = b"5\r\nhello\r\n4\r\nENDR\r\n0\r\n\r\n"
+
+    boundaries = []
+    for i in range(len(stream)):
+        scanner.feed(stream[i : i + 1])
+        boundaries.append(scanner.at_boundary)
+
+    assert b"".join(d for d, s in chunks if s == 5) == b"hello"
+    assert b"".join(d for d, s in chunks if s == 4) == b"ENDR"
+    assert [i + 1 for i, b in enumerate(boundaries) if b] == [10, 19]
+
+
+def test_progress_from_log(tmp_path):
+    log = tmp_path / "mars.log"
+    report = progress.Progress(str(log))
+    assert report.report(0).startswith(b'{"phase": "starting"')
+
+    log.write_text("Request cost: 12 fields, 1 Mbytes online\nCalling mars on")
+    report.update()
+    assert report.phase == "scheduled"
+    assert report.expected_fields == 12
+
+    with open(log, "a") as f:
+        f.write(" 'marser'\n12 fields retrieved from 'marser'\n")
+    report.update()
+    assert report.phase == "retrieved"
+    assert report.fields == 12
+
+
+def test_progress_and_stall_timeout(mars_servers, tmp_path):
+    url = mars_servers(mars_environ={"FAKE_MARS_DELAY": 3})
+    reports = []
+    cluster = client.RemoteMarsClientCluster(
+        urls=[url],
+        delay=0,
+        progress=reports.append,
+        progress_interval=1,
+        stall_timeout=2,
+    )
+
+    result = cluster.execute({"size": 1000}, {}, str(tmp_path / "data"))
+
+    assert not result.error
+    assert (tmp_path / "data").stat().st_size == 1000
+    assert len(reports) >= 2
+    assert reports[0]["phase"] == "scheduled"
+    assert reports[0]["expected_fields"] == 1
+
+
+def test_progress_interval_below_stall_timeout(mars_servers, tmp_path):
+    url = mars_servers()
+    cluster = client.RemoteMarsClientCluster(urls=[url], delay=0, stall_timeout=3)
+
+    # Progress reports every 10s would not come before the stall timeout
+    result = cluster.execute({"size": 1000, "delay": 5}, {}, str(tmp_path / "data"))
+
+    assert not result.error
+    assert (tmp_path / "data").stat().st_size == 1000
+
+
+def test_slow_answer_is_not_a_host_failure(mars_servers, tmp_path):
+    url = mars_servers()
+    hosts = health.HostHealth()
+    cluster = client.RemoteMarsClientCluster(
+        urls=[url], retries=1, delay=0, health=hosts, stall_timeout=0.5
+    )
+
+    # The server does not report progress more than once a second
+    result = cluster.execute({"size": 1000, "delay": 3}, {}, str(tmp_path / "data"))
+
+    assert result.error
+    assert hosts.state(url) == health.CLOSED
@@ -0,0 +1,60 @@
+import json
+
+from fake_mars import grib
+
+from cads_mars_server import chunked, client, gribindex
+
+
+def test_indexer_follows_rewinds():
+    indexer = gribindex.GribIndexer()
+    message = grib(100, 7)
+
+    indexer.on_chunk(message[:10], 100)
+    indexer.on_chunk(message[10:], 100)
+    indexer.on_chunk(chunked.RWND[:2], 4)
+    indexer.on_chunk(chunked.RWND[2:], 4)
+    for i in range(3):
+        indexer.on_chunk(grib(80, i), 80)
+
+    assert indexer.complete
+    assert [(m["offset"], m["length"], m["level"]) for m in indexer.messages] == [
+        (0, 80, 0),
+        (80, 80, 1),
+        (160, 80, 2),
+    ]
+    assert indexer.messages[0]["param"] == "0.0.4"
+    assert indexer.messages[0]["date"] == 20240102
+
+
+def test_indexer_ignores_other_formats():
+    indexer = gribindex.GribIndexer()
+    indexer.on_chunk(b"CDF\x01" + bytes(100), 104)
+    assert not indexer.complete
+    assert list(indexer.payloads()) == []
+
+
+def test_scanner_holds_back_the_end_of_the_stream():
+    scanner = chunked.ChunkScanner()
+    stream = b"5\r\nhello\r\n4\r\nENDR\r\n0\r\n\r\n"
+
+    relayed = b"".join(bytes(scanner.relay(stream[i : i + 3])) for i in range(0, 30, 3))
+    assert relayed == stream[:19]
+
+
+def test_index_sidecar(mars_server, tmp_path):
+    target = tmp_path / "data.grib"
+    cluster = client.RemoteMarsClientCluster(urls=[mars_server], delay=0, index=True)
+
+    requests = [{"size": 1000, "chunk": 200, "grib": 1}, {"size": 600}]
+    result = cluster.execute(requests, {}, str(target))
+
+    assert not result.error
+    data = target.read_bytes()
+    with open(gribindex.sidecar(target)) as f:
+        index = [json.loads(line) for line in f]
+
+    assert [m["level"] for m in index] == [0, 1, 2, 3, 4, 0, 1, 2]
+    assert [m["offset"] for m in index] == list(range(0, 1600, 200))
+    for m in index:
+        message = data[m["offset"] : m["offset"] + m["length"]]
+        assert message.startswith(b"GRIB") and message.endswith(b"7777")
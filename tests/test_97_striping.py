@@ -0,0 +1,67 @@
+import json
+import os
+import time
+
+from cads_mars_server import client, gribindex, striping
+
+
+def test_split():
+    request = {"date": "20240101", "levelist": [1, 2, 3, 4, 5], "param": "t/u"}
+    stripes = striping.split(request, 2)
+    assert [s["levelist"] for s in stripes] == ["1/2/3", "4/5"]
+    assert all(s["param"] == "t/u" for s in stripes)
+
+    assert striping.split({"date": "1/to/10"}, 4) == [{"date": "1/to/10"}]
+    assert len(striping.split({"step": "0/6"}, 4)) == 2
+
+
+def test_striped_retrieval(mars_servers, tmp_path):
+    urls = [mars_servers(), mars_servers()]
+    target = tmp_path / "data.grib"
+    target.write_bytes(b"previous")
+    cluster = client.RemoteMarsClientCluster(urls=urls, delay=0, stripes=3, index=True)
+
+    request = {"levelist": "1/2/3/4/5", "chunk": 100, "grib": 1}
+    result = cluster.execute(request, {}, str(target))
+
+    assert not result.error
+    assert target.stat().st_size == 500
+    with open(gribindex.sidecar(target)) as f:
+        index = [json.loads(line) for line in f]
+    assert [(m["offset"], m["level"]) for m in index] == [
+        (i * 100, i + 1) for i in range(5)
+    ]
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "data.grib",
+        "data.grib.index",
+        "server-0",
+        "server-1",
+    ]
+
+
+def test_failed_stripe_cancels_the_others(mars_servers, tmp_path):
+    urls = [
+        mars_servers(mars_environ={"FAKE_MARS_EXIT": 3}),
+        mars_servers(mars_environ={"FAKE_MARS_DELAY": 30}),
+    ]
+    cluster = client.RemoteMarsClientCluster(urls=urls, delay=0, stripes=2)
+
+    start = time.monotonic()
+    result = cluster.execute(
+        {"levelist": "1/2", "size": 100}, {}, str(tmp_path / "data")
+    )
+
+    assert result.error
+    assert time.monotonic() - start < 10
+    assert result.error.message == {"exited": 3}
+    assert not [p for p in tmp_path.iterdir() if "stripe" in p.name]
+
+
+def test_copy_without_copy_file_range(tmp_path, monkeypatch):
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    src.write_bytes(b"stripe")
+    dst.write_bytes(b"first-garbage")
+
+    assert striping._copy(str(src), str(dst), 5) == 6
+    assert dst.read_bytes() == b"firststripe"
@@ -0,0 +1,67 @@
+import threading
+
+from cads_mars_server import client, health
+
+
+def cluster(urls):
+    return client.RemoteMarsClientCluster(
+        urls=urls, delay=0, health=health.HostHealth()
+    )
+
+
+def test_draining_server_sends_clients_elsewhere(mars_servers, tmp_path):
+    urls = [mars_servers(), mars_servers()]
+    mars_servers.servers[0].drain()
+
+    assert client.session().head(urls[0]).status_code == 503
+    for _ in range(4):
+        result = cluster(urls).execute({"size": 100}, {}, str(tmp_path / "data"))
+        assert not result.error
+
+
+def test_stop_waits_for_running_requests(mars_servers, tmp_path):
+    url = mars_servers(mars_environ={"FAKE_MARS_DELAY": 2})
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(
+            cluster([url]).execute({"size": 1000}, {}, str(tmp_path / "data"))
+        )
+    )
+    thread.start()
+
+    while not mars_servers.servers[0].active_children:
+        thread.join(0.1)
+    mars_servers.servers[0].stop()
+    thread.join()
+
+    assert not results[0].error
+    assert (tmp_path / "data").stat().st_size == 1000
+
+
+def test_drain_timeout_fails_over(mars_servers, tmp_path):
+    slow = mars_servers(mars_environ={"FAKE_MARS_DELAY": 30}, drain_timeout=0.5)
+    url = mars_servers()
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(
+            cluster([slow, url]).failover(
+                [slow, url], {"size": 1000}, {}, str(tmp_path / "data"), "wb", 0
+            )
+        )
+    )
+    thread.start()
+
+    while not mars_servers.servers[0].active_children:
+        thread.join(0.1)
+    mars_servers.servers[0].stop()
+    thread.join(20)
+
+    assert not results[0].error
+    assert (tmp_path / "data").stat().st_size == 1000
+
+
+def test_mars_can_be_terminated(mars_server, tmp_path):
+    # SIGTERM is blocked by the handler only while MARS is started
+    result = cluster([mars_server]).execute({"size": 10}, {}, str(tmp_path / "data"))
+    assert not result.error
+    assert "Blocked signals []" in result.message
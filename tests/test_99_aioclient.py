@@ -0,0 +1,93 @@
+import asyncio
+import os
+import time
+
+from cads_mars_server import aioclient, health
+
+
+def run(coroutine):
+    # asyncio.run needs Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_concurrent_retrievals(mars_server, tmp_path):
+    cluster = aioclient.AsyncRemoteMarsClientCluster(
+        urls=["http://127.0.0.1:1", mars_server], delay=0, health=health.HostHealth()
+    )
+
+    async def main():
+        return await asyncio.gather(
+            *[
+                cluster.execute(
+                    {"size": 100_000 * (i + 1), "chunk": 3000},
+                    {},
+                    str(tmp_path / f"{i}"),
+                )
+                for i in range(20)
+            ]
+        )
+
+    results = run(main())
+
+    assert not any(r.error for r in results)
+    assert "Calling mars on" in results[0].message
+    for i in range(20):
+        assert (tmp_path / f"{i}").stat().st_size == 100_000 * (i + 1)
+
+
+def test_errors_and_progress(mars_servers, tmp_path):
+    url = mars_servers(mars_environ={"FAKE_MARS_DELAY": 2})
+    reports = []
+    cluster = aioclient.AsyncRemoteMarsClientCluster(
+        urls=[url], delay=0, progress=reports.append, progress_interval=1
+    )
+
+    result = run(cluster.execute({"size": 1000, "exit": 1}, {}, str(tmp_path / "x")))
+    assert result.error
+    assert not result.retry_next_host
+
+    result = run(cluster.execute([{"size": 10}, {"size": 20}], {}, str(tmp_path / "y")))
+    assert not result.error
+    assert (tmp_path / "y").stat().st_size == 30
+    assert reports and reports[0]["phase"] == "scheduled"
+
+
+def test_cancel_waits_for_the_executor(mars_server, tmp_path, monkeypatch):
+    feed = aioclient.StreamDecoder.feed
+    started = []
+    open_at_end = []
+
+    def slow_feed(self, data):
+        started.append(True)
+        time.sleep(0.5)
+        try:
+            os.fstat(self.writer.fd)
+            open_at_end.append(True)
+        except OSError:
+            open_at_end.append(False)
+        return feed(self, data)
+
+    monkeypatch.setattr(aioclient.StreamDecoder, "feed", slow_feed)
+    cluster = aioclient.AsyncRemoteMarsClientCluster(urls=[mars_server], delay=0)
+
+    async def main():
+        task = asyncio.ensure_future(
+            cluster.execute({"size": 1_000_000}, {}, str(tmp_path / "data"))
+        )
+        while not open_at_end:
+            await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return True
+
+    assert run(main())
+    # The last feed may still be running in the executor
+    while len(open_at_end) < len(started):
+        time.sleep(0.1)
+    assert all(open_at_end)
@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+
+import pytest
+
+from cads_mars_server import client, gribindex
+from cads_mars_server.cache import ResultCache, request_key
+
+
+def retriever(calls, data=b"GRIB", delay=0):
+    def retrieve(path):
+        calls.append(path)
+        time.sleep(delay)
+        with open(path, "wb") as f:
+            f.write(data)
+        return client.Result(message="done")
+
+    return retrieve
+
+
+def test_request_key():
+    assert request_key({"Param": "T/U", "date": [20240101]}) == request_key(
+        {"date": "20240101", "param": "t/u"}
+    )
+    assert request_key({"param": "t/u"}) != request_key({"param": "u/t"})
+
+
+def test_cache_hit(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    calls = []
+
+    for name in ("a.grib", "b.grib"):
+        result = cache.execute({"param": "t"}, str(tmp_path / name), retriever(calls))
+        assert not result.error
+        assert result.message == "done"
+
+    assert len(calls) == 1
+    assert (tmp_path / "b.grib").read_bytes() == b"GRIB"
+    assert not os.path.samefile(tmp_path / "a.grib", tmp_path / "b.grib")
+
+    cache.link = True
+    cache.execute({"param": "t"}, str(tmp_path / "c.grib"), retriever(calls))
+    entry = cache.entry(request_key({"param": "t"}))
+    assert os.path.samefile(entry, tmp_path / "c.grib")
+    # Linked targets cannot be rewritten in place
+    if os.geteuid() != 0:
+        with pytest.raises(PermissionError):
+            open(tmp_path / "c.grib", "wb")
+
+
+def test_single_fetch(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), link=False)
+    calls = []
+    retrieve = retriever(calls, delay=0.2)
+
+    threads = [
+        threading.Thread(
+            target=cache.execute,
+            args=({"param": "t"}, str(tmp_path / f"{i}.grib"), retrieve),
+        )
+        for i in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert all((tmp_path / f"{i}.grib").read_bytes() == b"GRIB" for i in range(4))
+
+
+def test_errors_not_cached(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    calls = []
+
+    def failing(path):
+        calls.append(path)
+        return client.Result(error="failed")
+
+    for _ in range(2):
+        result = cache.execute({"param": "t"}, str(tmp_path / "data.grib"), failing)
+        assert result.error
+    assert len(calls) == 2
+
+
+def test_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_size=250)
+    calls = []
+    target = str(tmp_path / "data.grib")
+
+    for param in ("t", "u", "v"):
+        cache.execute({"param": param}, target, retriever(calls, b"x" * 100))
+        time.sleep(0.01)
+
+    assert not os.path.exists(cache.entry(request_key({"param": "t"})))
+    assert os.path.exists(cache.entry(request_key({"param": "v"})))
+
+    # Hits make entries recent again
+    cache.execute({"param": "u"}, target, retriever(calls))
+    cache.execute({"param": "w"}, target, retriever(calls, b"x" * 100))
+    assert len(calls) == 4
+    assert os.path.exists(cache.entry(request_key({"param": "u"})))
+    assert not os.path.exists(cache.entry(request_key({"param": "v"})))
+
+    cache.max_age = 0
+    assert cache.evict(now=time.time() + 1) == 2
+
+
+def test_scans_only_when_over_size(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache"), max_size=250)
+    entries = cache._entries
+    scans = []
+    monkeypatch.setattr(cache, "_entries", lambda: scans.append(1) or entries())
+    calls = []
+    target = str(tmp_path / "data.grib")
+
+    for param in ("t", "u", "v", "w"):
+        cache.execute({"param": param}, target, retriever(calls, b"x" * 100))
+
+    # The first addition to a new cache, and the ones over 250 bytes
+    assert len(scans) == 3
+    # Locks are kept, so that all the workers always lock the same file
+    assert os.path.exists(cache.lock(cache.entry(request_key({"param": "t"}))))
+    assert len(os.listdir(tmp_path / "cache" / "locks")) <= 4
+
+
+def test_touch_is_best_effort(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache"))
+    calls = []
+    target = str(tmp_path / "data.grib")
+    cache.execute({"param": "t"}, target, retriever(calls))
+
+    def utime(path):
+        raise PermissionError(1, "Operation not permitted")
+
+    # As for entries of another user
+    monkeypatch.setattr(os, "utime", utime)
+    assert not cache.execute({"param": "t"}, target, retriever(calls)).error
+    assert len(calls) == 1
+
+
+def test_cluster_cache(mars_servers, tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    cluster = client.RemoteMarsClientCluster(
+        urls=[mars_servers()], delay=0, index=True, cache=cache
+    )
+    request = {"levelist": "1/2", "chunk": 100, "grib": 1}
+
+    first = tmp_path / "first.grib"
+    assert not cluster.execute(request, {}, str(first)).error
+
+    # Served from the cache, even with the server gone
+    cluster.urls = ["http://localhost:1"]
+    second = tmp_path / "second.grib"
+    assert not cluster.execute(request, {}, str(second)).error
+    assert second.read_bytes() == first.read_bytes()
+    assert os.path.exists(gribindex.sidecar(second))
+
+
+@pytest.mark.parametrize("link", [False, True])
+def test_target_rewritten(mars_servers, tmp_path, link):
+    url = mars_servers()
+    cache = ResultCache(str(tmp_path / "cache"), link=link)
+    cached = client.RemoteMarsClientCluster(urls=[url], delay=0, cache=cache)
+    uncached = client.RemoteMarsClientCluster(urls=[url], delay=0)
+    target = tmp_path / "data.grib"
+
+    assert not cached.execute({"size": 1000}, {}, str(target)).error
+    # Into the same target, linked to the entry of the cache
+    assert not uncached.execute({"size": 10}, {}, str(target)).error
+    assert target.stat().st_size == 10
+    assert not uncached.execute([{"size": 10}, {"size": 20}], {}, str(target)).error
+
+    assert not cached.execute({"size": 1000}, {}, str(target)).error
+    assert target.stat().st_size == 1000
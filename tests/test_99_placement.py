@@ -0,0 +1,70 @@
+import os
+import re
+
+import pytest
+
+from cads_mars_server import client, placement
+
+
+def test_parse():
+    assert placement.parse_cpulist("0-3,8,10-11\n") == {0, 1, 2, 3, 8, 10, 11}
+    assert placement.parse_ioprio("idle") == 3 << 13
+    assert placement.parse_ioprio("be/7") == 2 << 13 | 7
+    with pytest.raises(ValueError):
+        placement.parse_ioprio("be/9")
+
+    priorities = placement.Priorities.from_options(
+        "class", ["archive=10,idle", "default=,be/4"]
+    )
+    assert priorities.lookup({"class": "archive"}) == (10, 3 << 13)
+    assert priorities.lookup({}) == (None, 2 << 13 | 4)
+
+
+def test_groups():
+    cores = placement.Placement("cores", 1)
+    assert len(cores.groups) == len(os.sched_getaffinity(0))
+    assert placement.Placement("numa").groups
+    assert placement.Placement().groups == []
+
+
+def test_retrievals_take_sets_in_turn(mars_servers, tmp_path):
+    url = mars_servers(placement="cores", placement_size=1)
+    groups = mars_servers.servers[0].RequestHandlerClass.placement.groups
+    cluster = client.RemoteMarsClientCluster(urls=[url], delay=0)
+
+    seen = []
+    for i in range(len(groups)):
+        # Pings, log fetches and deletes do not count
+        result = cluster.execute({"size": 10}, {}, str(tmp_path / f"{i}"))
+        cpus = re.search(r"Running on CPUs \[([0-9, ]+)\]", result.message).group(1)
+        seen.append(int(cpus))
+
+    assert sorted(seen) == sorted(min(g) for g in groups)
+
+
+def test_placement_and_priorities(mars_servers, tmp_path):
+    url = mars_servers(placement="cores", placement_size=1, priorities=["slow=5,idle"])
+    cluster = client.RemoteMarsClientCluster(urls=[url], delay=0)
+
+    result = cluster.execute({"size": 10}, {"class": "slow"}, str(tmp_path / "a"))
+    assert not result.error
+    assert "nice 5" in result.message
+    cpus = re.search(r"Running on CPUs \[([0-9, ]+)\]", result.message).group(1)
+    cpus = {int(cpu) for cpu in cpus.split(",")}
+    assert len(cpus) == 1 and cpus <= os.sched_getaffinity(0)
+
+    result = cluster.execute({"size": 10}, {}, str(tmp_path / "b"))
+    assert f"nice {os.nice(0)}" in result.message
+
+
+def test_count_shared_across_fork():
+    policy = placement.Placement("cores", 1)
+    assert policy.next() == 0
+
+    pid = os.fork()
+    if pid == 0:
+        policy.next()
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert policy.next() == 2
@@ -0,0 +1,56 @@
+import uuid
+
+from cads_mars_server import client
+from cads_mars_server.profiling import FlightRecorder
+
+
+def test_flight_recorder_ring():
+    recorder = FlightRecorder(size=4)
+    for i in range(10):
+        recorder.read(i)
+    recorder.write(100, 0.5)
+
+    events = list(recorder.events())
+    assert [e["event"] for e in events] == ["read"] * 3 + ["write"]
+    assert [e["value"] for e in events] == [7, 8, 9, 100]
+    summary = recorder.summary()
+    assert summary["dropped"] == 7
+    assert summary["reads"] == 10
+    assert summary["bytes"] == 45
+    assert summary["writing"] == 0.5
+
+
+def retrieve(url, tmp_path):
+    uid = str(uuid.uuid4())
+    cluster = client.RemoteMarsClientCluster(urls=[url], delay=0)
+    result = cluster.execute(
+        {"size": 3000, "chunk": 1000}, {"request_id": uid}, str(tmp_path / "data")
+    )
+    assert not result.error
+    return uid
+
+
+def test_slow_request_profile(mars_servers, tmp_path):
+    url = mars_servers(profile_threshold=0)
+    uid = retrieve(url, tmp_path)
+
+    r = client.session().get(f"{url}/profile/{uid}")
+    assert r.status_code == 200
+    profile = r.json()
+    assert profile["uid"] == uid
+    assert profile["summary"]["bytes"] > 3000
+    assert profile["mars"]["ru_utime"] > 0
+    assert {"wake", "read", "write"} <= {e["event"] for e in profile["events"]}
+
+    # The profile outlives the log, deleted by the client
+    assert client.session().get(f"{url}/{uid}").status_code == 404
+
+
+def test_fast_request_not_profiled(mars_servers, tmp_path):
+    url = mars_servers(profile_threshold=3600)
+    uid = retrieve(url, tmp_path)
+    assert client.session().get(f"{url}/profile/{uid}").status_code == 404
+
+    url = mars_servers()
+    uid = retrieve(url, tmp_path)
+    assert client.session().get(f"{url}/profile/{uid}").status_code == 404